@@ -1,75 +1,282 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import aiohttp
 import asyncio
-import json
-from datetime import datetime
-from collections import defaultdict
+import sys
+import time
+from array import array
+from collections import deque
 import logging
+import numpy as np
+import pandas as pd
+from cachetools import TTLCache
+from WB_http import get_session, get_breaker, loads, iter_json_items, items_from_bytes, JSON_ERRORS, ADVERT_API, \
+    WBError, WBRateLimitError, WBTransportError
+from WB_cache import is_immutable, cache_key, get_cached, put_cached, CacheWriter
+from WB_limits import acquire, penalize, get_retry_after, get_sizer
+from WB_metrics import observe_response, observe_error
+from WB_tracing import span
+from WB_stats import NmStats
 
-async def safe_request(HEADERS, url, method='GET', json_data=None, params=None, max_retries=3):
+def decode_body(body, items=None):
+    """Разбирает сохранённое тело ответа так же, как safe_request разбирает живой ответ"""
+    if items is None:
+        return loads(body) if body else None
+    sink = items()
+    for item in items_from_bytes(body):
+        sink.add(item)
+    return sink
+
+
+async def safe_request(HEADERS, url, method='GET', json_data=None, params=None, max_retries=3, items=None, cache_date=None,
+                       batch_size=None):
+    """
+    Запрос к WB API с повторами при сетевых ошибках.
+
+    Если передан items — фабрика приёмника с методом add(item), — массив из
+    ответа разбирается потоково прямо в приёмник, и возвращается приёмник.
+    На каждую попытку создаётся новый приёмник, чтобы оборванный ответ не
+    попал в результат дважды.
+
+    cache_date — последний день, к которому относится запрос. Если этот день
+    уже закрыт, ответ берётся из локального кэша (WB_cache) без обращения к WB.
+
+    batch_size — число элементов в пакете запроса: время и размер ответа,
+    а также сетевые ошибки учитываются в размере пакета (WB_limits.get_sizer).
+    Если все попытки закончились сетевой ошибкой или выключатель хоста
+    отклонил запрос, возвращается {'error': 'transport'}.
+    """
+    cache_entry = None
+    if is_immutable(cache_date):
+        cache_entry = cache_key(HEADERS, url, json_data, params)
+        cached = get_cached(cache_entry)
+        if cached is not None:
+            try:
+                return decode_body(cached, items)
+            except JSON_ERRORS:
+                pass
+
+    session = get_session(url)
+    breaker = get_breaker(url)
+    sizer = get_sizer(HEADERS, url) if batch_size else None
+    transport_error = False
     for attempt in range(max_retries):
+        # Пока WB недоступен, не ждём таймаутов, а сразу сообщаем об ошибке
+        if not breaker.allow():
+            logging.warning(f"WB API {breaker.host} недоступен, запрос пропущен: {url}")
+            return {'error': 'transport'}
         try:
-            await asyncio.sleep(0.2)
-            async with aiohttp.ClientSession(headers=HEADERS) as session:
-                if method == 'GET':
-                    async with session.get(url, params=params, json=json_data, timeout=30) as response:
-                        response_text = await response.text()
-                        # Обработка 429
-                        if response.status == 429:
-                            retry_after = 20
-                            logging.warning(f"429 error. Retry after: {retry_after}")
-                            return {
-                                'error': 429,
-                                'retry_after': retry_after
-                            }
-                            
-                        # Остальная обработка
-                        if response.status == 400 and "no companies with correct intervals" in response_text:
-                            return None
-                        if response.status == 204:
-                            return None
-                        if 200 <= response.status < 300:
-                            try:
-                                return await response.json()
-                            except json.JSONDecodeError:
-                                return None
-
-                elif method == 'POST':
-                    async with session.post(url, json=json_data, params=params, timeout=30) as response:
-                        response_text = await response.text()
-                        # Обработка 429
-                        if response.status == 429:
-                            retry_after = 20
-                            logging.warning(f"429 error. Retry after: {retry_after}")
-                            return {
-                                'error': 429,
-                                'retry_after': retry_after
-                            }
-                            
-                        # Остальная обработка
-                        if response.status == 400 and "no companies with correct intervals" in response_text:
-                            return None
-                        if response.status == 204:
-                            return None
-                        if 200 <= response.status < 300:
-                            try:
-                                return await response.json()
-                            except json.JSONDecodeError:
-                                return None
+            await acquire(HEADERS, url)
+            started = time.monotonic()
+            async with session.request(method, url, headers=HEADERS, params=params,
+                                       json=json_data, timeout=30) as response:
+                observe_response(url, response.status, time.monotonic() - started)
+                breaker.record_response(response.status)
+                # Обработка 429
+                if response.status == 429:
+                    retry_after = get_retry_after(response.headers, 20)
+                    logging.warning(f"429 error. Retry after: {retry_after}")
+                    penalize(HEADERS, url, retry_after)
+                    return {
+                        'error': 429,
+                        'retry_after': retry_after
+                    }
+
+                # Остальная обработка
+                if response.status == 400 and "no companies with correct intervals" in await response.text():
+                    return None
+                if response.status == 204:
+                    return None
+                if 200 <= response.status < 300:
+                    writer = CacheWriter(cache_entry) if cache_entry else None
+                    received = 0
+
+                    def tee(chunk):
+                        nonlocal received
+                        received += len(chunk)
+                        if writer:
+                            writer.write(chunk)
+
+                    try:
+                        if items is None:
+                            body = await response.read()
+                            tee(body)
+                            result = loads(body) if body else None
+                        else:
+                            result = items()
+                            async for item in iter_json_items(response, tee=tee):
+                                result.add(item)
+                    except JSON_ERRORS:
+                        return None
+                    if writer:
+                        writer.commit()
+                    if sizer:
+                        sizer.record_success(batch_size, time.monotonic() - started, received)
+                    return result
+                # 5xx (в том числе 504 на слишком большой пакет) — как сетевая ошибка
+                transport_error = response.status >= 500
+                if transport_error and sizer:
+                    sizer.record_failure(batch_size)
 
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logging.error(f"Request error ({attempt+1}/{max_retries}): {e}")
-            await asyncio.sleep(2)
+            observe_error(url, e)
+            breaker.record_failure()
+            transport_error = True
+            if sizer:
+                sizer.record_failure(batch_size)
+            if attempt + 1 < max_retries:
+                await asyncio.sleep(2)
     
     logging.error(f"Failed to request: {url}")
+    if transport_error:
+        return {'error': 'transport'}
     return None
 
 
+# Сколько 429 подряд допускается, прежде чем загрузка прерывается с точкой возобновления
+CHUNK_MAX_RETRIES = 10
+# Сколько сетевых ошибок подряд допускается, прежде чем загрузка прерывается
+BATCH_MAX_FAILURES = 5
+# Сколько пакетов одной загрузки запрашивается одновременно
+BATCH_WORKERS = 5
+
+
+def batch_queue(groups):
+    """Очередь (группа, элементы) для fetch_batches из списка групп"""
+    return deque((group, list(elements)) for group, elements in groups if elements)
+
+
+async def fetch_batches(HEADERS, url, pending, make_body=None, items=None, cache_date=None):
+    """
+    Делит элементы на пакеты и отдаёт (группа, пакет, ответ) по мере готовности.
+
+    pending — очередь (группа, элементы) из batch_queue; пакет собирается из
+    элементов одной группы, тело запроса строит make_body(группа, пакет)
+    (по умолчанию — сам пакет). Размер пакета подбирается по ключу и
+    эндпоинту (WB_limits.get_sizer) и меняется по ходу загрузки. Темп
+    запросов ограничивает лимитер ключа. cache_date(группа) возвращает
+    последний день группы для кэша.
+
+    Отданные пакеты из очереди удаляются. Пакет, получивший 429, уходит в
+    конец очереди, после таймаута или сетевой ошибки — в начало (и дальше
+    меньшими частями). Если 429 или сетевые ошибки идут подряд дольше
+    допустимого, уже полученные ответы отдаются до конца, а затем
+    поднимается WBRateLimitError или WBTransportError; в pending остаются
+    только недогруженные пакеты, и повторный вызов с той же очередью
+    продолжает загрузку.
+    """
+    sizer = get_sizer(HEADERS, url)
+    ready = asyncio.Queue()
+    retries = 0
+    failures = 0
+    stopped = {}
+
+    async def worker():
+        nonlocal retries, failures
+        try:
+            while pending and not stopped:
+                group, elements = pending.popleft()
+                size = sizer.size
+                batch = elements[:size]
+                if len(elements) > size:
+                    pending.appendleft((group, elements[size:]))
+                body = make_body(group, batch) if make_body else batch
+                try:
+                    # Сетевую ошибку не повторяем внутри: пакет уходит заново меньшим
+                    response = await safe_request(HEADERS, url, 'POST', json_data=body, max_retries=1,
+                                                  items=items, batch_size=len(batch),
+                                                  cache_date=cache_date(group) if cache_date else None)
+                except asyncio.CancelledError:
+                    # Пакет без ответа не должен пропасть из точки возобновления
+                    pending.appendleft((group, batch))
+                    raise
+                if isinstance(response, dict) and response.get('error') == 429:
+                    # Паузу перед повтором выдерживает лимитер ключа
+                    pending.append((group, batch))
+                    retries += 1
+                    if retries > CHUNK_MAX_RETRIES:
+                        stopped['error'] = WBRateLimitError(response['retry_after'])
+                    continue
+                if isinstance(response, dict) and response.get('error') == 'transport':
+                    pending.appendleft((group, batch))
+                    failures += 1
+                    if failures >= BATCH_MAX_FAILURES:
+                        stopped['error'] = WBTransportError(
+                            f"{failures} сетевых ошибок подряд: {url}")
+                    continue
+                retries = 0
+                failures = 0
+                ready.put_nowait((group, batch, response))
+        finally:
+            ready.put_nowait(None)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(BATCH_WORKERS)]
+    try:
+        running = len(tasks)
+        while running:
+            result = await ready.get()
+            if result is None:
+                running -= 1
+                continue
+            yield result
+        # Ошибки воркеров передаются вызывающему
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if stopped:
+        raise stopped['error']
+
+
+def parse_campaign(campaign):
+    """Кампания из /promotion/adverts -> {advertId, tipe_comp, nmIds, ...}"""
+    nm_ids = []
+    type_comp = 'no'
+    if 'params' in campaign:
+        for param in campaign['params']:
+            for nm_item in param.get('nms', []):
+                if isinstance(nm_item, dict):
+                    nm_ids.append(nm_item.get('nm'))
+                else:
+                    nm_ids.append(nm_item)
+
+    if 'autoParams' in campaign:
+        auto_nms = campaign['autoParams'].get('nms', [])
+        if isinstance(auto_nms, list):
+            nm_ids.extend(auto_nms)
+        type_comp = 'auto'
+    if 'unitedParams' in campaign:
+        for param in campaign['unitedParams']:
+            united_nms = param.get('nms', [])
+            if isinstance(united_nms, list):
+                nm_ids.extend(united_nms)
+        type_comp = 'auction'
+
+    nm_ids = list(set(filter(lambda x: x is not None, nm_ids)))
+
+    return {
+        'advertId': campaign['advertId'],
+        'type': 'promotion',
+        'tipe_comp': type_comp,
+        'createTime': campaign.get('createTime', ''),
+        'expenses': 0,  # Временное значение
+        'nmIds': nm_ids
+    }
+
+
 async def get_promotion_campaigns(HEADERS):
     """Получение рекламных компаний с детализацией"""
-    count_url = "https://advert-api.wildberries.ru/adv/v1/promotion/count"
-    count_data = await safe_request(HEADERS, count_url, 'GET')
-    if not count_data:
+    count_url = f"{ADVERT_API}/adv/v1/promotion/count"
+    for attempt in range(CHUNK_MAX_RETRIES):
+        # Паузу перед повтором выдерживает лимитер ключа
+        count_data = await safe_request(HEADERS, count_url, 'GET')
+        if not (isinstance(count_data, dict) and count_data.get('error') == 429):
+            break
+    else:
+        raise WBRateLimitError(count_data['retry_after'])
+    if isinstance(count_data, dict) and count_data.get('error') == 'transport':
+        raise WBTransportError(f"Не удалось получить список кампаний: {count_url}")
+    if not count_data or count_data.get('error'):
         return []
 
     advert_ids = [advert['advertId']
@@ -80,150 +287,326 @@ async def get_promotion_campaigns(HEADERS):
         return []
 
     result = []
-    chunk_size = 50
-    for i in range(0, len(advert_ids), chunk_size):
-        chunk = advert_ids[i:i+chunk_size]
-
-        adverts_url = "https://advert-api.wildberries.ru/adv/v1/promotion/adverts"
-        campaigns = await safe_request(HEADERS, adverts_url, 'POST', json_data=chunk)
-
-        if not campaigns:
+    adverts_url = f"{ADVERT_API}/adv/v1/promotion/adverts"
+    async for _, _, campaigns in fetch_batches(HEADERS, adverts_url, batch_queue([(None, advert_ids)])):
+        if not isinstance(campaigns, list):
             continue
 
         for campaign in campaigns:
-            nm_ids = []
-            type_comp = 'no'
-            if 'params' in campaign:
-                for param in campaign['params']:
-                    for nm_item in param.get('nms', []):
-                        if isinstance(nm_item, dict):
-                            nm_ids.append(nm_item.get('nm'))
-                        else:
-                            nm_ids.append(nm_item)
-
-            if 'autoParams' in campaign:
-                auto_nms = campaign['autoParams'].get('nms', [])
-                if isinstance(auto_nms, list):
-                    nm_ids.extend(auto_nms)
-                type_comp = 'auto'
-            if 'unitedParams' in campaign:
-                for param in campaign['unitedParams']:
-                    united_nms = param.get('nms', [])
-                    if isinstance(united_nms, list):
-                        nm_ids.extend(united_nms)
-                type_comp = 'auction'
-
-            nm_ids = list(set(filter(lambda x: x is not None, nm_ids)))
-
-            result.append({
-                'advertId': campaign['advertId'],
-                'type': 'promotion',
-                'tipe_comp': type_comp,
-                'createTime': campaign.get('createTime', ''),
-                'expenses': 0,  # Временное значение
-                'nmIds': nm_ids
-            })
+            result.append(parse_campaign(campaign))
     return result
 
-async def get_expenses_per_nm(HEADERS, date=None):
-    """Возвращает расходы с возможностью возобновления обработки"""
-    # Получаем список кампаний с nmIds
+
+# Кэш кампаний по API ключу: состав кампаний меняется редко
+CAMPAIGNS_TTL = 30 * 60
+_campaigns_cache = TTLCache(maxsize=1024, ttl=CAMPAIGNS_TTL)
+
+
+async def get_cached_campaigns(HEADERS, refresh=False):
+    """Кампании ключа из кэша; при промахе или refresh=True запрашиваются у WB"""
+    api_key = HEADERS.get('Authorization')
+    if not refresh:
+        campaigns = _campaigns_cache.get(api_key)
+        if campaigns is not None:
+            return campaigns
+
     campaigns = await get_promotion_campaigns(HEADERS)
-    if not campaigns:
-        return {}
+    # Пустой результат может быть ошибкой API, его не кэшируем
+    if campaigns:
+        _campaigns_cache[api_key] = campaigns
+    return campaigns
+
+
+def invalidate_campaigns(api_key=None):
+    """Сбрасывает кэш кампаний ключа (или весь кэш, если ключ не указан)"""
+    if api_key is None:
+        _campaigns_cache.clear()
+    else:
+        _campaigns_cache.pop(api_key, None)
+
+
+# Поля результата по артикулу (см. WB_stats.NmStats)
+EXPENSE_FIELDS = (('sum', 'd'), ('views', 'q'), ('auto_clicks', 'q'), ('auto_views', 'q'),
+                  ('auction_clicks', 'q'), ('auction_views', 'q'))
+EXPENSE_NAMES = [name for name, _ in EXPENSE_FIELDS]
+
+# Колонки агрегатора: типизированные массивы (None — список дат)
+AGGREGATOR_COLUMNS = [('advert_ids', 'q'), ('dates', None), ('nm_ids', 'q'),
+                      ('sums', 'd'), ('views', 'q'), ('clicks', 'q')]
 
+# Сколько дней запрашивать в одном обращении к fullstats
+FULLSTATS_MAX_DAYS = 31
+
+
+class FullstatsAggregator:
+    """
+    Сводит ответы /adv/v2/fullstats в расходы по артикулам.
+
+    Каждый ответ один раз разворачивается в колонки (advertId, date, nmId,
+    sum, views, clicks), а суммы по nmId (или по дню и nmId) считаются одним
+    группированием pandas. Статистика кампании учитывается только для
+    артикулов из её nmIds.
+    """
+
+    def __init__(self, campaigns):
+        # Индекс кампаний по advertId вместо поиска по чанку
+        self.campaigns = {campaign['advertId']: campaign for campaign in campaigns}
+        self.responded = set()
+        for name, typecode in AGGREGATOR_COLUMNS:
+            setattr(self, name, array(typecode) if typecode else [])
+        # Исходные элементы ответа по advertId (только у частей с record=True)
+        self.received = None
+
+    def part(self, record=False):
+        """
+        Пустой агрегатор с тем же индексом кампаний (для одного ответа);
+        record=True сохраняет исходные элементы ответа для кэша по кампаниям
+        """
+        part = FullstatsAggregator([])
+        part.campaigns = self.campaigns
+        if record:
+            part.received = {}
+        return part
+
+    def merge(self, part):
+        self.responded |= part.responded
+        self.advert_ids.extend(part.advert_ids)
+        self.dates.extend(part.dates)
+        self.nm_ids.extend(part.nm_ids)
+        self.sums.extend(part.sums)
+        self.views.extend(part.views)
+        self.clicks.extend(part.clicks)
+
+    def add(self, campaign_data):
+        advert_id = campaign_data.get('advertId')
+        if self.received is not None:
+            self.received.setdefault(advert_id, []).append(campaign_data)
+        campaign = self.campaigns.get(advert_id)
+        if not campaign or not campaign['nmIds']:
+            return
+        self.responded.add(advert_id)
+
+        for day in campaign_data.get('days') or []:
+            # Одна строка даты на все строки дня
+            date = sys.intern((day.get('date') or '')[:10])
+            for camp_apps in day.get('apps') or []:
+                for camp_nms in camp_apps.get('nm') or []:
+                    self.advert_ids.append(advert_id)
+                    self.dates.append(date)
+                    self.nm_ids.append(camp_nms['nmId'])
+                    self.sums.append(camp_nms.get('sum', 0))
+                    self.views.append(int(camp_nms.get('views', 0)))
+                    self.clicks.append(int(camp_nms.get('clicks', 0)))
+
+    def _frame(self):
+        """Строки статистики, соединённые с составом кампаний"""
+        # Состав кампаний: пары (advertId, nmId) с типом кампании
+        members = [(advert_id, nm_id, self.campaigns[advert_id]['tipe_comp'])
+                   for advert_id in self.responded
+                   for nm_id in self.campaigns[advert_id]['nmIds']]
+        members = pd.DataFrame(members, columns=['advertId', 'nmId', 'type'])
+
+        # Копии массивов: представления не дали бы дописывать агрегатор
+        stats = pd.DataFrame({
+            'advertId': np.array(self.advert_ids, dtype=np.int64),
+            'date': np.asarray(self.dates, dtype=object),
+            'nmId': np.array(self.nm_ids, dtype=np.int64),
+            'sum': np.array(self.sums, dtype=np.float64),
+            'views': np.array(self.views, dtype=np.int64),
+            'clicks': np.array(self.clicks, dtype=np.int64),
+        })
+
+        # Артикулы кампании без статистики получают нули (и пустую дату)
+        merged = members.merge(stats, on=['advertId', 'nmId'], how='left')
+        merged[['sum', 'views', 'clicks']] = merged[['sum', 'views', 'clicks']].fillna(0)
+
+        is_auto = (merged['type'] == 'auto').to_numpy()
+        is_auction = (merged['type'] == 'auction').to_numpy()
+        views = merged['views'].to_numpy(dtype=np.int64)
+        clicks = merged['clicks'].to_numpy(dtype=np.int64)
+        merged['views'] = views
+        merged['auto_clicks'] = np.where(is_auto, clicks, 0)
+        merged['auto_views'] = np.where(is_auto, views, 0)
+        merged['auction_clicks'] = np.where(is_auction, clicks, 0)
+        merged['auction_views'] = np.where(is_auction, views, 0)
+        return merged
+
+    def result(self):
+        """Возвращает NmStats с полями EXPENSE_FIELDS за все дни"""
+        if not self.responded:
+            return NmStats(EXPENSE_FIELDS)
+        grouped = self._frame().groupby('nmId', sort=False)[EXPENSE_NAMES].sum()
+        return NmStats.from_frame(grouped, EXPENSE_FIELDS)
+
+    def result_by_day(self):
+        """Возвращает {'YYYY-MM-DD': NmStats с полями EXPENSE_FIELDS}"""
+        if not self.responded:
+            return {}
+        merged = self._frame().dropna(subset=['date'])
+        grouped = merged.groupby(['date', 'nmId'])[EXPENSE_NAMES].sum()
+        return {date: NmStats.from_frame(day.droplevel('date'), EXPENSE_FIELDS)
+                for date, day in grouped.groupby(level='date')}
+
+
+def date_windows(date_from, date_to, max_days=FULLSTATS_MAX_DAYS):
+    """Разбивает интервал дат на списки дней не длиннее max_days"""
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d")
+    end = datetime.strptime(date_to[:10], "%Y-%m-%d")
+    days = [(start + timedelta(days=i)).strftime("%Y-%m-%d")
+            for i in range((end - start).days + 1)]
+    return [days[i:i+max_days] for i in range(0, len(days), max_days)]
+
+
+FULLSTATS_URL = f"{ADVERT_API}/adv/v2/fullstats"
+
+
+def fullstats_cache_key(HEADERS, dates, campaign):
+    """
+    Ключ кэша fullstats одной кампании за окно дат. Состав и порядок пакетов
+    от запуска к запуску меняются, поэтому закрытые дни кэшируются по
+    кампаниям, а не целыми ответами.
+    """
+    return cache_key(HEADERS, FULLSTATS_URL, {'id': campaign['advertId'], 'dates': list(dates)})
+
+
+def load_cached_campaign(HEADERS, dates, campaign, aggregator):
+    """Добавляет в агрегатор статистику кампании из кэша; False — её там нет"""
+    cached = get_cached(fullstats_cache_key(HEADERS, dates, campaign))
+    if cached is None:
+        return False
+    try:
+        items = list(items_from_bytes(cached))
+    except JSON_ERRORS:
+        return False
+    for item in items:
+        aggregator.add(item)
+    return True
+
+
+async def collect_expenses(HEADERS, date_from, date_to, state=None):
+    """
+    Запрашивает fullstats за интервал: один запрос на чанк кампаний и окно дат
+
+    Ответы за закрытые дни кэшируются по кампаниям (fullstats_cache_key):
+    повторный запуск запрашивает только кампании, которых нет в кэше.
+
+    При долгих 429 или сетевых ошибках поднимается WBRateLimitError или
+    WBTransportError с точкой возобновления в state: полученный список
+    кампаний, агрегатор с уже разобранными пакетами и очередь оставшихся
+    пакетов. Повторный вызов с этим state (за тот же интервал) запрашивает
+    только оставшиеся пакеты.
+    """
+    if state is None:
+        state = {'campaigns': None, 'aggregator': None, 'pending': None}
+    try:
+        if state['campaigns'] is None:
+            # Получаем список кампаний с nmIds (из кэша, если он свежий)
+            with span('ads.campaigns') as stage:
+                campaigns = await get_cached_campaigns(HEADERS) or []
+                stage.set(campaigns=len(campaigns))
+            aggregator = FullstatsAggregator(campaigns)
+            # Кампании делятся на пакеты отдельно для каждого окна дат; за
+            # закрытые дни запрашиваются только кампании, которых нет в кэше
+            groups = []
+            for dates in date_windows(date_from, date_to):
+                dates = tuple(dates)
+                if is_immutable(dates[-1]):
+                    groups.append((dates, [campaign for campaign in campaigns
+                                           if not load_cached_campaign(HEADERS, dates, campaign, aggregator)]))
+                else:
+                    groups.append((dates, campaigns))
+            state['aggregator'] = aggregator
+            state['pending'] = batch_queue(groups)
+            state['campaigns'] = campaigns
+        aggregator = state['aggregator']
+        pending = state['pending']
+        if not pending:
+            return aggregator
+
+        def make_body(dates, batch):
+            return [{"id": campaign['advertId'], 'dates': list(dates)} for campaign in batch]
+
+        # Исходные элементы нужны, только если есть закрытые дни для кэша
+        record = is_immutable(date_from)
+        # Ответы разбираются потоково сразу в колонки агрегатора
+        with span('ads.fullstats', campaigns=len(state['campaigns']), pending=len(pending)):
+            async for dates, batch, part in fetch_batches(HEADERS, FULLSTATS_URL, pending, make_body,
+                                                          items=lambda: aggregator.part(record)):
+                if not isinstance(part, FullstatsAggregator):
+                    continue
+                if is_immutable(dates[-1]):
+                    # Кампании без статистики кэшируются пустым списком
+                    for campaign in batch:
+                        put_cached(fullstats_cache_key(HEADERS, dates, campaign),
+                                   part.received.get(campaign['advertId'], []))
+                part.received = None
+                # Результаты сливаются по мере поступления
+                aggregator.merge(part)
+    except WBError as e:
+        e.state = state
+        raise
+
+    return aggregator
+
+
+def dump_expenses_state(state):
+    """Точка возобновления collect_expenses в виде, пригодном для JSON"""
+    if not state or state['campaigns'] is None:
+        return None
+    aggregator = state['aggregator']
+    columns = {name: list(getattr(aggregator, name)) for name, _ in AGGREGATOR_COLUMNS}
+    columns['responded'] = sorted(aggregator.responded)
+    return {
+        'campaigns': state['campaigns'],
+        # Пакеты хранятся как номера кампаний
+        'pending': [[list(dates), [campaign['advertId'] for campaign in batch]]
+                    for dates, batch in state['pending']],
+        'aggregator': columns,
+    }
+
+
+def load_expenses_state(data):
+    """Обратное к dump_expenses_state"""
+    if not data:
+        return None
+    campaigns = data['campaigns']
+    by_id = {campaign['advertId']: campaign for campaign in campaigns}
+    aggregator = FullstatsAggregator(campaigns)
+    columns = data['aggregator']
+    for name, typecode in AGGREGATOR_COLUMNS:
+        setattr(aggregator, name, array(typecode, columns[name]) if typecode else columns[name])
+    aggregator.responded = set(columns['responded'])
+    return {
+        'campaigns': campaigns,
+        'aggregator': aggregator,
+        'pending': deque((tuple(dates), [by_id[advert_id] for advert_id in advert_ids])
+                         for dates, advert_ids in data['pending']),
+    }
+
+
+async def get_expenses_per_nm(HEADERS, date=None, state=None):
+    """
+    Возвращает расходы с возможностью возобновления обработки
+
+    :param state: WBError.state прерванного вызова за тот же день
+    :raises WBRateLimitError, WBTransportError: с точкой возобновления в state
+    """
     # Текущая дата
     if not date:
         date = datetime.now().strftime("%Y-%m-%d")
     else:
         date = date[:10]
 
-    # Формируем запросы по 100 кампаний
-    nm_expenses = defaultdict(dict)
-    auto_ctr = 0.0
-    auction_ctr = 0.0
-    
-    i = 0
-    while i < len(campaigns):
-        chunk = campaigns[i:i+100]
-        request_body = []
-
-        for campaign in chunk:
-            request_body.append({
-                "id": campaign['advertId'],
-                'dates': [date]
-            })
-
-        # Отправляем запрос для группы кампаний
-        fullstats_url = "https://advert-api.wildberries.ru/adv/v2/fullstats"
-        response = await safe_request(HEADERS, fullstats_url,
-                                'POST', json_data=request_body)
-
-        # Обработка 429 ошибки
-        if isinstance(response, dict) and response.get('error') == 429:
-            retry_after = 20
-            logging.warning(f"Ads API 429 error. Retry after: {retry_after}")
-            await asyncio.sleep(retry_after)
-            continue  # Повторяем с теми же данными
-            
-        if not response or not isinstance(response, list):
-            i += len(chunk)
-            continue
+    aggregator = await collect_expenses(HEADERS, date, date, state)
+    return aggregator.result()
 
-        # Обрабатываем ответ
-        for campaign_data in response:
-            advert_id = campaign_data.get('advertId')
 
-            # Находим соответствующую кампанию в нашем списке
-            campaign = next(
-                (c for c in chunk if c['advertId'] == advert_id), None)
-            if not campaign:
-                continue
+async def get_expenses_per_day(HEADERS, date_from, date_to, state=None):
+    """
+    Расходы и данные для CTR по дням за интервал
 
-            nmIds = campaign['nmIds']
-            if not nmIds: #or total_expense <= 0:
-                continue
-            
-            views_per_nm = {}
-            total_expense_per_nm = {}
-
-            auto_views_per_nm = {}
-            auto_clicks_per_nm = {}
-            
-            auction_views_per_nm = {}
-            auction_clicks_per_nm = {}
-            # print(campaign_data['days'][0])
-            for camp_apps in campaign_data['days'][0]['apps']:
-                for camp_nms in camp_apps['nm']:
-                    nm_Id = camp_nms['nmId']
-                    total_expense_per_nm[nm_Id] =  total_expense_per_nm.get(nm_Id, 0) + camp_nms.get('sum', 0)
-                    views_per_nm[nm_Id] = views_per_nm.get(nm_Id, 0) + camp_nms.get('views', 0)
-                    if campaign['tipe_comp'] == 'auto':
-                        auto_clicks_per_nm[nm_Id] = auto_clicks_per_nm.get(nm_Id, 0) + camp_nms.get('clicks', 0)
-                        auto_views_per_nm[nm_Id] = auto_views_per_nm.get(nm_Id, 0) + camp_nms.get('views', 0)
-
-                    elif campaign['tipe_comp'] == 'auction':
-                        auction_clicks_per_nm[nm_Id] = auction_clicks_per_nm.get(nm_Id, 0) + camp_nms.get('clicks', 0)
-                        auction_views_per_nm[nm_Id] = auction_views_per_nm.get(nm_Id, 0) + camp_nms.get('views', 0)
-
-
-                        
-
-            # Распределяем затраты по артикулам
-            # expense_per_nm = total_expense / len(nmIds)
-            # views_per_nm = views / len(nmIds)
-            # auto_ctr_per_nm = auto_ctr / len(nmIds)
-            # auction_ctr_per_nm =  auction_ctr / len(nmIds)
-            for nmId in nmIds:
-                nm_expenses[nmId]['sum'] = nm_expenses[nmId].get('sum', 0) + total_expense_per_nm.get(nmId, 0)
-                nm_expenses[nmId]['views'] = nm_expenses[nmId].get('views', 0) + views_per_nm.get(nmId, 0)
-
-                nm_expenses[nmId]['auto_clicks'] = nm_expenses[nmId].get('auto_clicks', 0) + auto_clicks_per_nm.get(nmId, 0)
-                nm_expenses[nmId]['auto_views'] = nm_expenses[nmId].get('auto_views', 0) + auto_views_per_nm.get(nmId, 0)
-                nm_expenses[nmId]['auction_clicks'] = nm_expenses[nmId].get('auction_clicks', 0) + auction_clicks_per_nm.get(nmId, 0)
-                nm_expenses[nmId]['auction_views'] = nm_expenses[nmId].get('auction_views', 0) + auction_views_per_nm.get(nmId, 0)
-            
-            # print(nm_expenses)
-        i += len(chunk)
-    
-    return dict(nm_expenses)
\ No newline at end of file
+    :param state: WBError.state прерванного вызова за тот же интервал
+    :return: {'YYYY-MM-DD': NmStats с полями EXPENSE_FIELDS}
+    """
+    aggregator = await collect_expenses(HEADERS, date_from, date_to, state)
+    return aggregator.result_by_day()
@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import types
+import subprocess
+import urllib.request
+from datetime import datetime
+
+# Замер ночного отчёта (main_from_config -> generate_dayli_report) на
+# синтетических данных: WB заменяет WB_simulator.py, Google Sheets —
+# таблицы в памяти. Каждый масштаб запускается в отдельном процессе,
+# чтобы пиковая память и кэши модулей не переходили между замерами.
+#
+# Запуск: python WB_benchmark.py --scale 10:100 --scale 100:1000
+# Результаты: benchmarks/<время>.json
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = "benchmarks"
+# Масштабы по умолчанию: (кабинетов, nmID в кабинете)
+SCALES = [(10, 100), (100, 1000), (1000, 100), (10, 20000)]
+CABINETS_PER_USER = 2
+SCALE_TIMEOUT = 3 * 60 * 60
+
+
+class BenchWorksheet:
+    """Лист Google Sheets в памяти"""
+
+    def __init__(self, bench, records=None):
+        self.bench = bench
+        self.rows = []
+        self.records = records or []
+        self.col_count = 15
+        self.row_count = 100
+
+    def get_all_records(self, **kwargs):
+        self.bench.sheet_call()
+        return self.records
+
+    def get_all_values(self):
+        self.bench.sheet_call()
+        return self.rows
+
+    def col_values(self, col):
+        self.bench.sheet_call()
+        return [row[col - 1] if len(row) >= col else '' for row in self.rows]
+
+    def append_row(self, row):
+        self.bench.sheet_call()
+        self.rows.append(row)
+
+    def insert_row(self, row, index):
+        self.bench.sheet_call()
+        self.rows.insert(index - 1, row)
+
+    def update(self, range_name, values):
+        self.bench.sheet_call()
+        start = int(''.join(ch for ch in range_name.split(':')[0] if ch.isdigit()))
+        while len(self.rows) < start - 1:
+            self.rows.append([])
+        self.rows[start - 1:start - 1 + len(values)] = values
+
+    def add_rows(self, count):
+        self.bench.sheet_call()
+        self.row_count += count
+
+    def add_cols(self, count):
+        self.bench.sheet_call()
+        self.col_count += count
+
+    def format(self, *args, **kwargs):
+        self.bench.sheet_call()
+
+    def batch_format(self, *args, **kwargs):
+        self.bench.sheet_call()
+
+    def merge_cells(self, *args, **kwargs):
+        self.bench.sheet_call()
+
+    def freeze(self, *args, **kwargs):
+        self.bench.sheet_call()
+
+
+class BenchSpreadsheet:
+    """Таблица клиента: лист "Маржа" и листы кабинетов"""
+
+    def __init__(self, bench, margin_records):
+        self.bench = bench
+        self.sheets = {"Маржа": BenchWorksheet(bench, margin_records)}
+
+    def worksheet(self, name):
+        import gspread
+        self.bench.sheet_call()
+        if name not in self.sheets:
+            raise gspread.exceptions.WorksheetNotFound(name)
+        return self.sheets[name]
+
+    def add_worksheet(self, title, rows, cols):
+        self.bench.sheet_call()
+        self.sheets[title] = BenchWorksheet(self.bench)
+        return self.sheets[title]
+
+
+class BenchClient:
+    def __init__(self, bench):
+        self.bench = bench
+
+    def open_by_key(self, sheet_id):
+        return self.bench.spreadsheets[sheet_id]
+
+
+class BenchCache:
+    """Замена UserDataCache: подписка есть у всех"""
+
+    async def get_user_subscription_per_username(self, username):
+        return True
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class Bench:
+    """Один замер: заданное число кабинетов с nm_ids карточек в каждом"""
+
+    def __init__(self, cabinets, nm_ids, sheets_latency=0.0):
+        self.cabinets = cabinets
+        self.nm_ids = nm_ids
+        self.sheets_latency = sheets_latency
+        self.sheet_calls = 0
+        self.stages = {}
+        self.configs = {}
+        self.spreadsheets = {}
+
+        margin = [{"Артикул WB": 100000 + i, "Артикул продавца": f"ART-{i}",
+                   "Прибыль с ед. товара": 150, "Выкупаемость (%)": 60}
+                  for i in range(nm_ids)]
+        for i in range(cabinets):
+            user = f"user{i // CABINETS_PER_USER}"
+            sheet_id = f"sheet-{user}"
+            cabinet = f"cabinet{i}"
+            self.configs.setdefault(user, []).append((sheet_id, f"key-{i}", cabinet))
+            spreadsheet = self.spreadsheets.get(sheet_id)
+            if spreadsheet is None:
+                spreadsheet = self.spreadsheets[sheet_id] = BenchSpreadsheet(self, [])
+            spreadsheet.sheets["Маржа"].records.extend(
+                dict(row, **{"Личный кабинет": cabinet}) for row in margin)
+
+    def sheet_call(self):
+        self.sheet_calls += 1
+        if self.sheets_latency:
+            # gspread синхронный и так же блокирует цикл событий
+            time.sleep(self.sheets_latency)
+
+    def timed(self, stage, func):
+        """Обёртка, суммирующая время и число вызовов этапа"""
+        totals = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+
+        if asyncio.iscoroutinefunction(func):
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    totals["calls"] += 1
+                    totals["seconds"] += time.perf_counter() - start
+        else:
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    totals["calls"] += 1
+                    totals["seconds"] += time.perf_counter() - start
+        return wrapper
+
+
+async def run_single(args):
+    """Замер одного масштаба в текущем процессе; результат — JSON в stdout"""
+    cabinets, nm_ids = parse_scale(args.single)
+    os.environ["WB_API_BASE"] = f"http://127.0.0.1:{args.port}"
+    sys.path.insert(0, REPO_DIR)
+    # config.py при импорте читает credentials.json; таблицы в замере
+    # подменяются, поэтому хватает заглушки с теми же именами
+    sys.modules["config"] = types.SimpleNamespace(CONFIG_URL="benchmark", CREDS=None)
+    import aiohttp
+    import Wb_bot
+    import WB_limits
+    from WB_http import close_sessions
+
+    # Каталоги и кэши пишутся во временную папку, а не в рабочую
+    os.chdir(tempfile.mkdtemp(prefix="wb-bench-"))
+
+    if args.limits == "off":
+        for family in WB_limits.LIMITS:
+            WB_limits.LIMITS[family] = (0.0001, 1000)
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    bench = Bench(cabinets, nm_ids, args.sheets_latency)
+
+    async def read_config(config_url):
+        return bench.configs
+
+    Wb_bot.read_config = read_config
+    Wb_bot.gspread.authorize = lambda creds: BenchClient(bench)
+    Wb_bot.get_catalog_cards = bench.timed("cards", Wb_bot.get_catalog_cards)
+    Wb_bot.get_dict_orders = bench.timed("orders", Wb_bot.get_dict_orders)
+    Wb_bot.get_expenses_per_nm = bench.timed("ads", Wb_bot.get_expenses_per_nm)
+    Wb_bot.cabinet_metrics = bench.timed("metrics", Wb_bot.cabinet_metrics)
+    Wb_bot.update_google_sheet_multi = bench.timed("sheet_write", Wb_bot.update_google_sheet_multi)
+
+    start = time.perf_counter()
+    await Wb_bot.main_from_config(BenchCache(), "benchmark")
+    # main_from_config только ставит задачи; ждём, пока все отчёты завершатся
+    await asyncio.sleep(0)
+    await Wb_bot.nightly_idle.wait()
+    wall_time = time.perf_counter() - start
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{args.port}/simulator/stats") as response:
+            simulator = await response.json()
+    await close_sessions()
+
+    written = sum(1 for spreadsheet in bench.spreadsheets.values()
+                  for name in spreadsheet.sheets if name != "Маржа")
+    return {
+        "cabinets": cabinets,
+        "nm_ids": nm_ids,
+        "wall_seconds": round(wall_time, 3),
+        "stages": {stage: {"calls": totals["calls"], "seconds": round(totals["seconds"], 3)}
+                   for stage, totals in bench.stages.items()},
+        "http_calls": sum(simulator["requests"].values()),
+        "http_calls_by_endpoint": simulator["requests"],
+        "http_429": simulator["faults"].get("429", 0),
+        "http_5xx": simulator["faults"].get("5xx", 0),
+        "sheet_calls": bench.sheet_calls,
+        "sheets_written": written,
+        "errors_logged": errors.count,
+        # На Linux ru_maxrss в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def parse_scale(value):
+    cabinets, nm_ids = value.split(":")
+    return int(cabinets), int(nm_ids)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_simulator(args, nm_ids, port):
+    """Запускает симулятор в отдельном процессе и ждёт его готовности"""
+    command = [sys.executable, os.path.join(REPO_DIR, "WB_simulator.py"), "--port", str(port),
+               "--cards", str(nm_ids), "--campaigns", str(args.campaigns or max(nm_ids // 10, 1)),
+               "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+               "--rate-limit-rate", str(args.rate_limit_rate)]
+    if args.limits == "wb":
+        command.append("--enforce-limits")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/simulator/stats", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Симулятор WB API не запустился")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_all(args):
+    scales = [parse_scale(value) for value in args.scale] if args.scale else SCALES
+    results = []
+    for cabinets, nm_ids in scales:
+        print(f"Масштаб: {cabinets} кабинетов x {nm_ids} nmID", flush=True)
+        port = free_port()
+        simulator = start_simulator(args, nm_ids, port)
+        try:
+            command = [sys.executable, os.path.abspath(__file__), "--single", f"{cabinets}:{nm_ids}",
+                       "--port", str(port), "--limits", args.limits,
+                       "--sheets-latency", str(args.sheets_latency)]
+            completed = subprocess.run(command, cwd=REPO_DIR, capture_output=True, text=True,
+                                       timeout=SCALE_TIMEOUT)
+            lines = completed.stdout.strip().splitlines()
+            if completed.returncode != 0 or not lines:
+                result = {"cabinets": cabinets, "nm_ids": nm_ids,
+                          "error": completed.stderr.strip().splitlines()[-1:] or f"код {completed.returncode}"}
+            else:
+                result = json.loads(lines[-1])
+        except subprocess.TimeoutExpired:
+            result = {"cabinets": cabinets, "nm_ids": nm_ids, "error": "timeout"}
+        finally:
+            simulator.terminate()
+            simulator.wait()
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+        results.append(result)
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "settings": {"limits": args.limits, "latency": args.latency, "error_rate": args.error_rate,
+                     "rate_limit_rate": args.rate_limit_rate, "sheets_latency": args.sheets_latency},
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер ночного отчёта на синтетических данных")
+    parser.add_argument("--scale", action="append", help="КАБИНЕТОВ:NMID, можно указать несколько раз")
+    parser.add_argument("--limits", choices=("off", "wb"), default="off",
+                        help="off — без лимитов WB (чистое время кода), wb — реальные лимиты")
+    parser.add_argument("--campaigns", type=int, default=0, help="Кампаний в кабинете (по умолчанию nmID/10)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа WB, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 5xx")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля случайных ответов 429")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="Задержка вызова Google Sheets, сек")
+    parser.add_argument("--output", help="Файл с результатами")
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(asyncio.run(run_single(args)), ensure_ascii=False))
+    else:
+        run_all(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+# Локальный кэш ответов WB за закрытые дни
+CACHE_DIR = "wb_cache"
+# Данные за день считаются неизменными через столько дней после него
+IMMUTABLE_AFTER_DAYS = 2
+# Предельный размер кэша на диске, байт
+MAX_CACHE_SIZE = 500 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+# Текущий размер кэша (считается при первом обращении)
+_cache_size = None
+
+
+def is_immutable(date):
+    """Закрыт ли день date ('YYYY-MM-DD...') настолько, что ответ за него можно кэшировать"""
+    if not date:
+        return False
+    try:
+        day = datetime.strptime(date[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return False
+    return day <= datetime.now().date() - timedelta(days=IMMUTABLE_AFTER_DAYS)
+
+
+def cache_key(headers, url, body=None, params=None):
+    """Ключ по содержимому: хэш API ключа, адрес и тело запроса"""
+    key_hash = hashlib.sha256(headers.get('Authorization', '').encode()).hexdigest()
+    payload = json.dumps([key_hash, url, body, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.z")
+
+
+def get_cached(key):
+    """Тело ответа из кэша или None"""
+    path = _path(key)
+    try:
+        with open(path, 'rb') as f:
+            data = zlib.decompress(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, zlib.error) as e:
+        logging.error(f"Ошибка чтения кэша {path}: {e}")
+        return None
+    # Время изменения служит временем последнего обращения при вытеснении
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return data
+
+
+class CacheWriter:
+    """Сжимает тело ответа по частям и сохраняет его только после успешного чтения"""
+
+    def __init__(self, key):
+        self.key = key
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+        self.parts = []
+
+    def write(self, chunk):
+        self.parts.append(self.compressor.compress(chunk))
+
+    def commit(self):
+        global _cache_size
+        self.parts.append(self.compressor.flush())
+        data = b''.join(self.parts)
+        self.parts = []
+        path = _path(self.key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Ошибка записи кэша {path}: {e}")
+            return
+        if _cache_size is not None:
+            _cache_size += len(data)
+        evict()
+
+
+def put_cached(key, value):
+    """Сохраняет value в кэш в виде JSON (для частей ответа, разобранных вызывающим)"""
+    writer = CacheWriter(key)
+    writer.write(json.dumps(value, ensure_ascii=False).encode())
+    writer.commit()
+
+
+def _entries():
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            if name.endswith('.z'):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+
+def evict(max_size=None):
+    """Удаляет давно не использованные записи, пока кэш больше max_size"""
+    global _cache_size
+    max_size = MAX_CACHE_SIZE if max_size is None else max_size
+    if _cache_size is not None and _cache_size <= max_size:
+        return
+    entries = sorted(_entries())
+    _cache_size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if _cache_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            _cache_size -= size
+        except OSError as e:
+            logging.error(f"Ошибка удаления из кэша {path}: {e}")
@@ -0,0 +1,134 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import aiohttp
+from datetime import datetime, timedelta
+from WB_orders import fetch_cards_page
+from WB_tracing import span
+
+# Каталог карточек хранится по файлу на API ключ
+CATALOG_DIR = "cards_catalog"
+# Как часто дозагружать изменения карточек
+SYNC_INTERVAL = timedelta(minutes=15)
+# Полная перезагрузка, чтобы убрать удалённые карточки
+FULL_SYNC_INTERVAL = timedelta(days=7)
+
+
+class CardCatalog:
+    """Локальный каталог карточек одного ключа с курсором по updatedAt"""
+
+    def __init__(self, api_key):
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        self.path = os.path.join(CATALOG_DIR, f"{key_hash}.json")
+        self.cards = {}         # {nmID: vendorCode}
+        self.cursor = None      # {'updatedAt', 'nmID'} последней загруженной карточки
+        self.synced_at = None
+        self.full_synced_at = None
+        self.lock = asyncio.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.cards = {int(k): v for k, v in data.get('cards', {}).items()}
+            self.cursor = data.get('cursor')
+            if data.get('full_synced_at'):
+                self.full_synced_at = datetime.fromisoformat(data['full_synced_at'])
+        except Exception as e:
+            logging.error(f"Ошибка загрузки каталога карточек {self.path}: {e}")
+
+    def save(self):
+        data = {
+            'cursor': self.cursor,
+            'full_synced_at': self.full_synced_at.isoformat() if self.full_synced_at else None,
+            'cards': self.cards
+        }
+        try:
+            os.makedirs(CATALOG_DIR, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения каталога карточек {self.path}: {e}")
+
+    async def sync(self, headers, force=False):
+        """Догружает карточки, изменённые после сохранённого курсора"""
+        async with self.lock:
+            now = datetime.now()
+            if not force and self.synced_at and now - self.synced_at < SYNC_INTERVAL:
+                return True
+
+            full = (not self.cards or not self.full_synced_at
+                    or now - self.full_synced_at > FULL_SYNC_INTERVAL)
+            cards = {} if full else self.cards
+            cursor = None if full else self.cursor
+
+            try:
+                for i in range(1000):
+                    data, limit = await fetch_cards_page(headers, cursor, ascending=True)
+                    if data is None:
+                        return False
+
+                    for card in data.get("cards", []):
+                        cards[card.get("nmID")] = card.get("vendorCode")
+
+                    page_cursor = data.get("cursor")
+                    if page_cursor and page_cursor.get("updatedAt"):
+                        cursor = {
+                            "updatedAt": page_cursor["updatedAt"],
+                            "nmID": page_cursor["nmID"]
+                        }
+                    if not page_cursor or page_cursor.get("total", 0) < limit:
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Ошибка синхронизации карточек: {e}")
+                return False
+
+            self.cards = cards
+            self.cursor = cursor
+            self.synced_at = now
+            if full:
+                self.full_synced_at = now
+            self.save()
+            logging.info(f"Каталог карточек синхронизирован ({'полностью' if full else 'изменения'}): {len(cards)}")
+            return True
+
+    def as_cards(self):
+        """Карточки в формате get_wb_product_cards"""
+        return [{"vendorCode": vendor_code, "nmID": nm_id}
+                for nm_id, vendor_code in self.cards.items()]
+
+
+# Каталоги в памяти: {api_key: CardCatalog}
+_catalogs = {}
+
+
+def get_catalog(api_key):
+    catalog = _catalogs.get(api_key)
+    if catalog is None:
+        catalog = CardCatalog(api_key)
+        _catalogs[api_key] = catalog
+    return catalog
+
+
+async def get_catalog_cards(headers, force=False):
+    """
+    Возвращает карточки ключа из локального каталога, предварительно
+    догрузив изменения. Если WB недоступен, отдаёт сохранённые данные.
+
+    :return: Список словарей {'vendorCode', 'nmID'} или None, если данных нет
+    """
+    catalog = get_catalog(headers.get('Authorization', ''))
+    with span('cards.sync'):
+        synced = await catalog.sync(headers, force=force)
+    if not synced:
+        logging.warning("Не удалось обновить каталог карточек, используются сохранённые данные")
+    if not catalog.cards:
+        return None
+    return catalog.as_cards()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+
+# Выполняющиеся загрузки: {(api_key, дата, вид данных): Flight}
+_flights = {}
+
+
+class Flight:
+    """Одна общая загрузка, которую ждут все одновременные вызовы с тем же ключом"""
+
+    def __init__(self):
+        self.task = None
+        self.listeners = []
+
+    async def notify(self, *args):
+        """Передаёт прогресс загрузки всем ожидающим"""
+        for listener in list(self.listeners):
+            try:
+                result = listener(*args)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logging.error(f"Ошибка обработчика прогресса: {e}")
+
+
+async def single_flight(key, fetch, on_progress=None):
+    """
+    Выполняет fetch(notify) один раз для всех одновременных вызовов с ключом key
+
+    Пока загрузка идёт, повторный вызов с тем же ключом не делает новых
+    запросов к WB, а ждёт общий результат. Результат один на всех вызовов и
+    не копируется: вызывающие только читают его (метрики строятся через
+    NmStats.to_frame). Отмена одного из ожидающих не прерывает загрузку
+    для остальных.
+
+    :param key: (API ключ, дата, вид данных)
+    :param fetch: Функция, принимающая notify и возвращающая корутину загрузки
+    :param on_progress: Обработчик прогресса этого вызова
+    """
+    flight = _flights.get(key)
+    if flight is None:
+        flight = Flight()
+        flight.task = asyncio.ensure_future(fetch(flight.notify))
+        _flights[key] = flight
+
+        def forget(_):
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+        flight.task.add_done_callback(forget)
+    else:
+        logging.info(f"Ожидание уже идущей загрузки: {key[2]} за {key[1]}")
+
+    if on_progress:
+        flight.listeners.append(on_progress)
+    try:
+        result = await asyncio.shield(flight.task)
+    finally:
+        if on_progress:
+            flight.listeners.remove(on_progress)
+    return result
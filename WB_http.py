@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from yarl import URL
+
+# Необязательные ускорители: orjson — быстрый разбор JSON,
+# ijson — потоковый разбор больших ответов без загрузки всего тела
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Ошибки разбора JSON для всех бэкендов (orjson.JSONDecodeError — подкласс ValueError)
+JSON_ERRORS = (ValueError,) + ((ijson.JSONError,) if ijson is not None else ())
+
+# Базовые адреса WB API. Переменные окружения позволяют направить запросы
+# на локальный симулятор (WB_simulator.py): WB_API_BASE — все хосты сразу,
+# WB_ADVERT_API и т.п. — отдельный хост
+_API_BASE = os.getenv("WB_API_BASE")
+ADVERT_API = os.getenv("WB_ADVERT_API", _API_BASE or "https://advert-api.wildberries.ru")
+ANALYTICS_API = os.getenv("WB_ANALYTICS_API", _API_BASE or "https://seller-analytics-api.wildberries.ru")
+CONTENT_API = os.getenv("WB_CONTENT_API", _API_BASE or "https://content-api.wildberries.ru")
+STATISTICS_API = os.getenv("WB_STATISTICS_API", _API_BASE or "https://statistics-api.wildberries.ru")
+
+# Настройки пула соединений
+LIMIT_PER_HOST = 20       # Максимум одновременных соединений на хост
+DNS_CACHE_TTL = 300       # Время жизни DNS-кэша, сек
+KEEPALIVE_TIMEOUT = 60    # Сколько держать простаивающее соединение, сек
+REQUEST_TIMEOUT = 30      # Таймаут запроса по умолчанию, сек
+STREAM_CHUNK_SIZE = 64 * 1024  # Размер части тела при потоковом разборе
+
+# Настройки автоматического выключателя
+FAILURE_THRESHOLD = 5     # Сколько ошибок подряд размыкают цепь
+RESET_TIMEOUT = 60        # Через сколько секунд пробовать снова, сек
+
+# Одна сессия на каждый хост WB: {host: ClientSession}
+_sessions = {}
+
+
+def get_session(url):
+    """Возвращает общую сессию с keep-alive для хоста, к которому относится url"""
+    host = URL(url).host
+    session = _sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=LIMIT_PER_HOST,
+            limit_per_host=LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+        _sessions[host] = session
+        logging.info(f"Открыта сессия для {host}")
+    return session
+
+
+async def close_sessions():
+    """Закрывает все сессии (вызывается при остановке бота)"""
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
+    # Даём SSL-соединениям корректно закрыться
+    if sessions:
+        await asyncio.sleep(0.25)
+
+
+class CircuitBreaker:
+    """
+    Выключатель для хоста WB: после FAILURE_THRESHOLD сетевых ошибок или
+    ответов 5xx подряд запросы сразу отклоняются. Через RESET_TIMEOUT секунд
+    пропускается один пробный запрос: успех замыкает цепь, ошибка снова
+    размыкает её.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.probe_until = 0.0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < RESET_TIMEOUT:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """Можно ли отправить запрос (в полуоткрытом состоянии — один пробный)"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        now = time.monotonic()
+        # Пробный запрос, который не завершился, не блокирует хост навсегда
+        if now < self.probe_until:
+            return False
+        self.probe_until = now + REQUEST_TIMEOUT
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"WB API {self.host} снова доступен")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= FAILURE_THRESHOLD:
+            if self.opened_at is None:
+                logging.error(f"WB API {self.host} недоступен: {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+            self.probe_until = 0.0
+
+    def record_response(self, status):
+        """Учитывает ответ: 5xx — сбой хоста, остальные коды — хост работает"""
+        if status >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+# Выключатели по хостам: {host: CircuitBreaker}
+_breakers = {}
+
+
+def get_breaker(url):
+    host = URL(url).host
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = CircuitBreaker(host)
+        _breakers[host] = breaker
+    return breaker
+
+
+def unavailable_hosts():
+    """Хосты WB, запросы к которым сейчас отклоняются"""
+    return [host for host, breaker in _breakers.items() if breaker.state == 'open']
+
+
+class WBError(Exception):
+    """
+    Загрузка из WB API прервана; state — точка возобновления: передав её
+    в ту же функцию, загрузка продолжается с места остановки
+    """
+
+    def __init__(self, message, state=None):
+        super().__init__(message)
+        self.state = state
+
+
+class WBRateLimitError(WBError):
+    """WB отвечает 429 дольше допустимого; retry_after — пауза из заголовков"""
+
+    def __init__(self, retry_after, state=None):
+        super().__init__(f"WB API 429, повтор через {retry_after} сек", state)
+        self.retry_after = retry_after
+
+
+class WBTransportError(WBError):
+    """Таймауты, сетевые ошибки или 5xx подряд"""
+
+
+def loads(data):
+    """Разбирает JSON (bytes или str) через orjson, если он установлен"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def read_json(response):
+    """Читает тело ответа один раз в байтах и разбирает его без промежуточной строки"""
+    body = await response.read()
+    if not body:
+        return None
+    return loads(body)
+
+
+def _select(data, prefix):
+    """Элементы по пути вида 'data.item' из уже разобранного JSON"""
+    nodes = [data]
+    for part in prefix.split('.'):
+        if part == 'item':
+            nodes = [item for node in nodes if isinstance(node, list) for item in node]
+        else:
+            nodes = [node.get(part) for node in nodes if isinstance(node, dict)]
+    return nodes
+
+
+def items_from_bytes(body, prefix='item'):
+    """Элементы массива из уже полученного тела (например, из кэша)"""
+    if not body:
+        return []
+    return _select(loads(body), prefix)
+
+
+async def iter_json_items(response, prefix='item', tee=None):
+    """
+    Потоково отдаёт элементы массива из тела ответа (prefix в нотации ijson:
+    'item' — корневой массив, 'data.item' — массив в поле data).
+    Без ijson тело читается целиком и разбирается обычным способом.
+    tee получает сырые части тела (для записи в кэш).
+    """
+    if ijson is None:
+        body = await response.read()
+        if tee:
+            tee(body)
+        for item in items_from_bytes(body, prefix):
+            yield item
+        return
+
+    events = ijson.sendable_list()
+    parser = ijson.items_coro(events, prefix, use_float=True)
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        if tee:
+            tee(chunk)
+        parser.send(chunk)
+        for item in events:
+            yield item
+        del events[:]
+    parser.close()
+    for item in events:
+        yield item
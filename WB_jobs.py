@@ -0,0 +1,146 @@
+import os
+import json
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+
+from WB_stats import NmStats
+
+# Журнал ночных отчётов: до какого этапа дошёл каждый кабинет за дату и
+# частичное состояние загрузки. Журнал переживает перезапуск бота: при
+# старте и при повторном запуске задачи продолжаются только незавершённые
+# кабинеты, а записанные в лист не запрашиваются и не дописываются снова.
+JOBS_DB = os.getenv("WB_JOBS_DB", "jobs.sqlite3")
+
+# Сколько последних дней дозапускать при старте и сколько дней хранить записи
+RESUME_DAYS = 2
+KEEP_DAYS = 14
+
+# Этапы отчёта кабинета по порядку
+QUEUED = 'queued'      # поставлен в очередь, загрузка не начата
+ORDERS = 'orders'      # загружаются заказы (в состоянии — очередь nmID)
+ADS = 'ads'            # заказы получены, загружается реклама
+METRICS = 'metrics'    # заказы и реклама получены
+WRITING = 'writing'    # идёт запись в лист
+DONE = 'done'          # записано (или записывать нечего)
+
+# Открытое соединение с журналом
+_connection = None
+
+
+def _connect():
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(JOBS_DB)
+        # WAL: запись этапа не теряется при аварийном завершении процесса
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                user TEXT NOT NULL,
+                cabinet TEXT NOT NULL,
+                date TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                state TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (user, cabinet, date)
+            )
+        """)
+        _connection.commit()
+    return _connection
+
+
+def _json_default(value):
+    # Числа numpy из расчётов pandas
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} не сериализуется в JSON")
+
+
+def dump_stats(stats):
+    """NmStats -> вид для JSON"""
+    if stats is None:
+        return None
+    return stats.dump()
+
+
+def load_stats(data, fields):
+    """Обратное к dump_stats; записи прежнего формата не восстанавливаются"""
+    if not isinstance(data, dict):
+        return None
+    return NmStats.load(data, fields)
+
+
+def get_job(user, cabinet, date):
+    """
+    Этап и сохранённое состояние отчёта кабинета за дату
+
+    :return: (этап, словарь состояния) или (None, {}), если записи нет
+    """
+    try:
+        row = _connect().execute(
+            "SELECT stage, state FROM jobs WHERE user = ? AND cabinet = ? AND date = ?",
+            (user, cabinet, date)).fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка чтения журнала отчётов: {e}")
+        return None, {}
+    if row is None:
+        return None, {}
+    stage, state = row
+    try:
+        return stage, json.loads(state) if state else {}
+    except ValueError as e:
+        logging.error(f"Повреждённое состояние отчёта {user} [{cabinet}] за {date}: {e}")
+        return stage, {}
+
+
+def save_job(user, cabinet, date, stage, state=None):
+    """Записывает достигнутый этап и состояние (None — состояние не нужно)"""
+    try:
+        connection = _connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO jobs (user, cabinet, date, stage, state, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user, cabinet, date, stage,
+             json.dumps(state, ensure_ascii=False, default=_json_default) if state is not None else None,
+             datetime.now().isoformat(timespec='seconds')))
+        connection.commit()
+    except (sqlite3.Error, TypeError, ValueError) as e:
+        logging.error(f"Ошибка записи журнала отчётов: {e}")
+
+
+def queue_jobs(user, cabinets, date):
+    """Ставит кабинеты в очередь; уже начатые и завершённые записи не трогает"""
+    try:
+        connection = _connect()
+        now = datetime.now().isoformat(timespec='seconds')
+        connection.executemany(
+            "INSERT OR IGNORE INTO jobs (user, cabinet, date, stage, state, updated_at) "
+            "VALUES (?, ?, ?, ?, NULL, ?)",
+            [(user, cabinet, date, QUEUED, now) for cabinet in cabinets])
+        connection.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка записи журнала отчётов: {e}")
+
+
+def unfinished_dates(days=RESUME_DAYS):
+    """Даты за последние days дней, по которым остались незавершённые кабинеты"""
+    since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    try:
+        rows = _connect().execute(
+            "SELECT DISTINCT date FROM jobs WHERE stage != ? AND date >= ? ORDER BY date",
+            (DONE, since)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка чтения журнала отчётов: {e}")
+        return []
+    return [date for date, in rows]
+
+
+def prune_jobs(days=KEEP_DAYS):
+    """Удаляет записи старше days дней"""
+    before = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    try:
+        connection = _connect()
+        connection.execute("DELETE FROM jobs WHERE date < ?", (before,))
+        connection.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка очистки журнала отчётов: {e}")
@@ -0,0 +1,200 @@
+import asyncio
+import time
+import random
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from yarl import URL
+
+# Лимиты WB API по семействам эндпоинтов (из документации WB):
+# (интервал пополнения в секундах, размер всплеска)
+LIMITS = {
+    'adv_count': (0.2, 5),            # /adv/v1/promotion/count — 5 запросов в секунду
+    'adv_adverts': (0.2, 5),          # /adv/v1/promotion/adverts — 5 запросов в секунду
+    'adv_fullstats': (20, 1),         # /adv/v2/fullstats — 3 запроса в минуту
+    'nm_report_detail': (20, 3),      # /api/v2/nm-report/detail/history — 3 запроса в минуту
+    'nm_report_grouped': (20, 3),     # /api/v2/nm-report/grouped/history — 3 запроса в минуту
+    'cards_list': (0.6, 5),           # /content/v2/get/cards/list — 100 запросов в минуту
+    'supplier_orders': (60, 1),       # /api/v1/supplier/orders — 1 запрос в минуту
+    'ping': (10, 3),                  # /ping — 3 запроса в 30 секунд
+    'default': (0.2, 5),
+}
+
+# Случайная добавка к паузе, чтобы кабинеты не возвращались одновременно
+JITTER = 0.5
+
+# Соответствие пути запроса семейству лимитов
+ENDPOINT_FAMILIES = {
+    '/adv/v1/promotion/count': 'adv_count',
+    '/adv/v1/promotion/adverts': 'adv_adverts',
+    '/adv/v2/fullstats': 'adv_fullstats',
+    '/api/v2/nm-report/detail/history': 'nm_report_detail',
+    '/api/v2/nm-report/grouped/history': 'nm_report_grouped',
+    '/content/v2/get/cards/list': 'cards_list',
+    '/api/v1/supplier/orders': 'supplier_orders',
+    '/ping': 'ping',
+}
+
+
+class TokenBucket:
+    """Корзина токенов: выдаёт разрешения на запросы с заданной скоростью"""
+
+    def __init__(self, interval, burst):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+        self.updated = now
+
+    async def acquire(self):
+        # Ожидающие получают разрешения по очереди (asyncio.Lock честный)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) * self.interval
+                await asyncio.sleep(wait)
+
+    def block(self, seconds):
+        """Запрещает запросы на seconds секунд (например, после 429)"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        # После паузы начинаем с одного токена, а не с полного всплеска
+        self.tokens = 0.0
+        self.updated = self.blocked_until - self.interval
+
+
+def _parse_seconds(value):
+    """Секунды из заголовка: число или HTTP-дата (для Retry-After)"""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def get_retry_after(response_headers, default):
+    """
+    Определяет паузу после 429 по заголовкам ответа WB
+
+    X-Ratelimit-Retry — через сколько секунд можно повторить запрос,
+    Retry-After — то же в стандартном виде, X-Ratelimit-Reset — через
+    сколько секунд лимит восстановится полностью.
+    """
+    for name in ('X-Ratelimit-Retry', 'Retry-After', 'X-Ratelimit-Reset'):
+        seconds = _parse_seconds(response_headers.get(name))
+        if seconds is not None:
+            break
+    else:
+        seconds = default
+    return round(seconds + random.uniform(0, JITTER + seconds * 0.1), 2)
+
+
+# Корзины по ключу: {(api_key, семейство): TokenBucket}
+_buckets = {}
+
+
+def get_family(url):
+    """Определяет семейство лимитов по адресу запроса"""
+    return ENDPOINT_FAMILIES.get(URL(url).path, 'default')
+
+
+def get_bucket(headers, url):
+    api_key = headers.get('Authorization', '')
+    family = get_family(url)
+    bucket = _buckets.get((api_key, family))
+    if bucket is None:
+        interval, burst = LIMITS[family]
+        bucket = TokenBucket(interval, burst)
+        _buckets[(api_key, family)] = bucket
+    return bucket
+
+
+# Размеры пакетов по семействам: (минимум, максимум по документации WB)
+BATCH_LIMITS = {
+    'adv_adverts': (5, 50),           # /adv/v1/promotion/adverts — до 50 ID
+    'adv_fullstats': (5, 100),        # /adv/v2/fullstats — до 100 кампаний
+    'nm_report_detail': (2, 20),      # /api/v2/nm-report/detail/history — до 20 nmID
+    'cards_list': (10, 100),          # /content/v2/get/cards/list — до 100 карточек
+}
+# Ответ дольше SLOW_RESPONSE секунд или больше MAX_RESPONSE_BYTES уменьшает
+# пакет, ответ быстрее FAST_RESPONSE на полный пакет — увеличивает
+SLOW_RESPONSE = 15
+FAST_RESPONSE = 5
+MAX_RESPONSE_BYTES = 20 * 1024 * 1024
+
+
+class BatchSizer:
+    """
+    Размер пакета для семейства эндпоинтов одного ключа.
+
+    Начинает с максимума WB. Таймаут или сетевая ошибка уменьшают пакет
+    вдвое, медленный или слишком большой ответ — на четверть. Быстрый ответ
+    на пакет полного размера увеличивает его на шаг, но не выше максимума.
+    """
+
+    def __init__(self, family, minimum, maximum):
+        self.family = family
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = maximum
+        self.step = max(1, maximum // 10)
+
+    def _resize(self, size):
+        size = max(self.minimum, min(self.maximum, int(size)))
+        if size != self.size:
+            logging.info(f"Размер пакета {self.family}: {self.size} -> {size}")
+        self.size = size
+
+    def record_success(self, items, seconds, response_bytes=0):
+        if seconds > SLOW_RESPONSE or response_bytes > MAX_RESPONSE_BYTES:
+            self._resize(min(self.size, items) * 3 // 4)
+        elif seconds < FAST_RESPONSE and items >= self.size:
+            self._resize(self.size + self.step)
+
+    def record_failure(self, items):
+        self._resize(min(self.size, items) // 2)
+
+
+# Размеры пакетов по ключу: {(api_key, семейство): BatchSizer}
+_sizers = {}
+
+
+def get_sizer(headers, url):
+    api_key = headers.get('Authorization', '')
+    family = get_family(url)
+    sizer = _sizers.get((api_key, family))
+    if sizer is None:
+        minimum, maximum = BATCH_LIMITS.get(family, (1, 1))
+        sizer = BatchSizer(family, minimum, maximum)
+        _sizers[(api_key, family)] = sizer
+    return sizer
+
+
+async def acquire(headers, url):
+    """Ждёт разрешения на запрос к url в рамках лимита ключа"""
+    await get_bucket(headers, url).acquire()
+
+
+def penalize(headers, url, seconds):
+    """Приостанавливает запросы ключа к семейству url на seconds секунд"""
+    logging.info(f"Лимит {get_family(url)}: пауза {seconds} сек.")
+    get_bucket(headers, url).block(seconds)
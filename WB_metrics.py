@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from aiohttp import web
+from WB_limits import get_family
+
+# Метрики процесса бота в текстовом формате Prometheus.
+# Адрес: http://127.0.0.1:9108/metrics (порт — WB_METRICS_PORT,
+# 0 отключает сервер метрик)
+METRICS_HOST = os.getenv("WB_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("WB_METRICS_PORT", "9108"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин гистограмм, сек
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Метрика с набором меток: значения хранятся по кортежу значений меток"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, _format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Гистограмма: накопительные корзины, сумма и число наблюдений"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [счётчики по корзинам (последняя — +Inf), сумма]
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labels, key, [('le', _format_value(bound))]), cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labels, key), total
+            yield f"{self.name}_count", _format_labels(self.labels, key), cumulative
+
+
+# Реестр всех метрик процесса: {имя: Metric}
+_registry = {}
+
+
+def _register(metric):
+    _registry[metric.name] = metric
+    return metric
+
+
+# Запросы к WB API по семействам эндпоинтов (см. WB_limits.ENDPOINT_FAMILIES)
+WB_REQUESTS = _register(Counter(
+    'wb_requests_total', 'Запросы к WB API по эндпоинтам и кодам ответа', ('endpoint', 'status')))
+WB_LATENCY = _register(Histogram(
+    'wb_request_duration_seconds', 'Время ответа WB API', ('endpoint',)))
+WB_RATE_LIMITED = _register(Counter(
+    'wb_rate_limited_total', 'Ответы 429 от WB API', ('endpoint',)))
+WB_TIMEOUTS = _register(Counter(
+    'wb_timeouts_total', 'Таймауты запросов к WB API', ('endpoint',)))
+WB_ERRORS = _register(Counter(
+    'wb_transport_errors_total', 'Сетевые ошибки запросов к WB API', ('endpoint',)))
+
+# Google Sheets
+SHEETS_LATENCY = _register(Histogram(
+    'sheets_operation_duration_seconds', 'Время операций с Google Sheets', ('operation',)))
+SHEETS_ERRORS = _register(Counter(
+    'sheets_errors_total', 'Ошибки операций с Google Sheets', ('operation',)))
+
+# Telegram
+TELEGRAM_LATENCY = _register(Histogram(
+    'telegram_request_duration_seconds', 'Время вызовов Telegram Bot API', ('method',)))
+TELEGRAM_FAILURES = _register(Counter(
+    'telegram_failures_total', 'Неудачные вызовы Telegram Bot API', ('method', 'error')))
+
+# Отчёты и планировщик
+REPORT_DURATION = _register(Histogram(
+    'report_duration_seconds', 'Время построения отчёта по кабинету', ('kind',), DURATION_BUCKETS))
+REPORT_LAST_DURATION = _register(Gauge(
+    'report_last_duration_seconds', 'Время последнего отчёта по кабинету', ('kind', 'user', 'cabinet')))
+REPORT_RESULTS = _register(Counter(
+    'report_results_total', 'Отчёты по кабинетам по результату', ('kind', 'result')))
+REPORT_TASKS = _register(Gauge(
+    'report_tasks', 'Задачи run_report: ждут семафор или выполняются', ('state',)))
+JOB_DURATION = _register(Histogram(
+    'scheduler_job_duration_seconds', 'Время выполнения задач планировщика', ('job',), DURATION_BUCKETS))
+JOB_FAILURES = _register(Counter(
+    'scheduler_job_failures_total', 'Задачи планировщика, завершившиеся ошибкой', ('job',)))
+
+
+def observe_response(url, status, seconds):
+    """Учитывает ответ WB API: код, время ответа и 429"""
+    endpoint = get_family(url)
+    WB_REQUESTS.inc(endpoint=endpoint, status=status)
+    WB_LATENCY.observe(seconds, endpoint=endpoint)
+    if status == 429:
+        WB_RATE_LIMITED.inc(endpoint=endpoint)
+
+
+def observe_error(url, error):
+    """Учитывает сетевую ошибку или таймаут запроса к WB API"""
+    endpoint = get_family(url)
+    if isinstance(error, asyncio.TimeoutError):
+        WB_TIMEOUTS.inc(endpoint=endpoint)
+        WB_REQUESTS.inc(endpoint=endpoint, status='timeout')
+    else:
+        WB_ERRORS.inc(endpoint=endpoint)
+        WB_REQUESTS.inc(endpoint=endpoint, status='error')
+
+
+def observe_sheets(operation, seconds, failed=False):
+    """Учитывает операцию с Google Sheets"""
+    SHEETS_LATENCY.observe(seconds, operation=operation)
+    if failed:
+        SHEETS_ERRORS.inc(operation=operation)
+
+
+class sheets_operation:
+    """Контекстный менеджер: время и ошибки одной операции с Google Sheets"""
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_sheets(self.operation, time.monotonic() - self.start, failed=exc_type is not None)
+        return False
+
+
+def observe_report(kind, user, cabinet, seconds, result):
+    """Учитывает построение отчёта по кабинету (kind: daily или bot)"""
+    REPORT_DURATION.observe(seconds, kind=kind)
+    REPORT_LAST_DURATION.set(round(seconds, 3), kind=kind, user=user, cabinet=cabinet)
+    REPORT_RESULTS.inc(kind=kind, result=result)
+
+
+def timed_job(job_id, func):
+    """Обёртка задачи планировщика, измеряющая её время и ошибки"""
+
+    async def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except Exception:
+            JOB_FAILURES.inc(job=job_id)
+            raise
+        finally:
+            JOB_DURATION.observe(time.monotonic() - start, job=job_id)
+
+    wrapper.__name__ = getattr(func, '__name__', job_id)
+    return wrapper
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request):
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+# Запущенный сервер метрик
+_runner = None
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускает HTTP сервер с /metrics в текущем цикле событий"""
+    global _runner
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return
+    _runner = runner
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        runner, _runner = _runner, None
+        await runner.cleanup()
@@ -3,16 +3,28 @@ import json
 import time
 import asyncio
 import logging
+from collections import deque
+from datetime import datetime, timedelta
+from WB_http import get_session, get_breaker, loads, read_json, iter_json_items, items_from_bytes, JSON_ERRORS, ANALYTICS_API, CONTENT_API, STATISTICS_API
+from WB_cache import is_immutable, cache_key, get_cached, CacheWriter
+from WB_limits import acquire, penalize, get_retry_after, get_sizer
+from WB_metrics import observe_response, observe_error
+from WB_tracing import span
+from WB_ads import safe_request
+from WB_stats import NmStats
 
 async def get_wb_grouped_stats(target_date, headers):
     """
     Получает статистику по всем карточкам товаров за указанную дату
 
+    WB делит ответ на группы по предметам, брендам и ярлыкам, поэтому
+    статистика кабинета — сумма по всем группам.
+
     :param target_date: Дата в формате 'YYYY-MM-DD'
     :param headers: Заголовки запроса с авторизацией
-    :return: Словарь со статистикой или None при ошибке
+    :return: Список словарей со статистикой дня по группам или None при ошибке
     """
-    API_URL = "https://seller-analytics-api.wildberries.ru/api/v2/nm-report/grouped/history"
+    API_URL = f"{ANALYTICS_API}/api/v2/nm-report/grouped/history"
 
     # Формирование тела запроса
     payload = {
@@ -27,52 +39,137 @@ async def get_wb_grouped_stats(target_date, headers):
         "aggregationLevel": "day"
     }
 
+    breaker = get_breaker(API_URL)
+    if not breaker.allow():
+        logging.warning(f"WB API {breaker.host} недоступен, запрос пропущен")
+        return None
     try:
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.post(
-                API_URL,
-                data=json.dumps(payload),
-                timeout=30
-            ) as response:
-                # Проверка успешности запроса
-                if response.status != 200:
-                    print(f"Ошибка API ({response.status}): {await response.text()}")
-                    return None
+        session = get_session(API_URL)
+        await acquire(headers, API_URL)
+        started = time.monotonic()
+        async with session.post(
+            API_URL,
+            headers=headers,
+            data=json.dumps(payload),
+            timeout=30
+        ) as response:
+            observe_response(API_URL, response.status, time.monotonic() - started)
+            breaker.record_response(response.status)
+            # Проверка успешности запроса
+            if response.status != 200:
+                logging.error(f"Ошибка API ({response.status}): {await response.text()}")
+                return None
 
-                data = await response.json()
+            data = await read_json(response)
 
-                # Проверка на ошибки в ответе
-                if data.get("error"):
-                    print(
-                        f"Ошибка в ответе API: {data.get('errorText', 'Неизвестная ошибка')}")
-                    return None
+            # Проверка на ошибки в ответе
+            if data.get("error"):
+                logging.error(f"Ошибка в ответе API: {data.get('errorText', 'Неизвестная ошибка')}")
+                return None
 
-                # Извлечение статистики
-                stats = data.get("data", [])
+            # Извлечение статистики
+            stats = data.get("data", [])
 
-                if not stats:
-                    print(f"Нет данных за {target_date}")
-                    return None
+            if not stats:
+                logging.warning(f"Нет данных за {target_date}")
+                return None
 
-                # Получение истории из первой группы (все карточки)
-                group_data = stats[0]
-                daily_stats = group_data.get("history", [])
+            # Статистика за запрошенный день из каждой группы
+            daily_stats = [group["history"][0] for group in stats if group.get("history")]
 
-                if not daily_stats:
-                    print(f"Нет статистики за {target_date}")
-                    return None
+            if not daily_stats:
+                logging.warning(f"Нет статистики за {target_date}")
+                return None
 
-                # Возвращаем статистику за запрошенный день
-                return daily_stats[0]
+            return daily_stats
 
     except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-        print(f"Ошибка соединения: {e}")
+        logging.error(f"Ошибка соединения: {e}")
+        observe_error(API_URL, e)
+        breaker.record_failure()
         return None
-    except json.JSONDecodeError:
-        print("Ошибка обработки JSON-ответа")
+    except JSON_ERRORS:
+        logging.error("Ошибка обработки JSON-ответа")
         return None
 
 
+# Наибольший размер страницы и число повторов после 429 для /cards/list
+CARDS_PAGE_LIMIT = 100
+CARDS_MAX_RETRIES = 10
+# Сколько таймаутов подряд допускается для одной страницы
+CARDS_MAX_TIMEOUTS = 3
+
+
+async def fetch_cards_page(headers, cursor=None, ascending=False):
+    """
+    Запрашивает одну страницу карточек
+
+    Размер страницы подбирается по ключу (WB_limits.get_sizer): после
+    таймаута страница запрашивается снова с меньшим размером.
+
+    :param cursor: Курсор {'updatedAt', 'nmID'} предыдущей страницы
+    :param ascending: Сортировка по возрастанию updatedAt (для дозагрузки изменений)
+    :return: (ответ WB {'cards': [...], 'cursor': {...}} или None при ошибке,
+             размер запрошенной страницы)
+    """
+    url = f"{CONTENT_API}/content/v2/get/cards/list"
+    sizer = get_sizer(headers, url)
+    payload = {
+        "settings": {
+            "filter": {"withPhoto": -1},
+            "cursor": {"limit": sizer.size}
+        }
+    }
+    if ascending:
+        payload["settings"]["sort"] = {"ascending": True}
+
+    # Добавляем курсор для пагинации (кроме первого запроса)
+    if cursor:
+        payload["settings"]["cursor"].update({
+            "updatedAt": cursor["updatedAt"],
+            "nmID": cursor["nmID"]
+        })
+
+    session = get_session(url)
+    breaker = get_breaker(url)
+    timeouts = 0
+    for attempt in range(CARDS_MAX_RETRIES):
+        limit = payload["settings"]["cursor"]["limit"]
+        if not breaker.allow():
+            logging.warning(f"WB API {breaker.host} недоступен, запрос карточек пропущен")
+            return None, limit
+        # Отправляем запрос в рамках лимита ключа (100/мин)
+        await acquire(headers, url)
+        try:
+            started = time.monotonic()
+            async with session.post(url, headers=headers, json=payload, timeout=30) as response:
+                observe_response(url, response.status, time.monotonic() - started)
+                breaker.record_response(response.status)
+                # Обработка ошибок
+                if response.status != 200:
+                    print(f"Ошибка {response.status}: {await response.text()}")
+                    if response.status == 429:
+                        reset_time = get_retry_after(response.headers, 70)
+                        print(f"Лимит запросов. Пауза {reset_time} сек.")
+                        penalize(headers, url, reset_time)
+                        continue
+                    return None, limit
+
+                body = await response.read()
+                sizer.record_success(limit, time.monotonic() - started, len(body))
+                return (loads(body) if body else None), limit
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            observe_error(url, e)
+            breaker.record_failure()
+            sizer.record_failure(limit)
+            timeouts += 1
+            if timeouts >= CARDS_MAX_TIMEOUTS:
+                raise
+            # Повторяем ту же страницу меньшего размера
+            payload["settings"]["cursor"]["limit"] = sizer.size
+    return None, payload["settings"]["cursor"]["limit"]
+
+
 async def get_wb_product_cards(headers):
     """
     Получает информацию по всем карточкам товаров с пагинацией
@@ -80,69 +177,25 @@ async def get_wb_product_cards(headers):
     :param api_key: API-ключ авторизации
     :return: Список словарей с данными по артикулам
     """
-    url = "https://content-api.wildberries.ru/content/v2/get/cards/list"
-
     all_cards = []
     cursor = None
-    request_count = 0
-    start_time = time.time()
-    i = 0
     try:
-        async with aiohttp.ClientSession(headers=headers) as session:
-            while i < 1000:
-                i+=1
-                # Формируем тело запроса с пагинацией
-                payload = {
-                    "settings": {
-                        "filter": {"withPhoto": -1},
-                        "cursor": {"limit": 100}
-                    }
-                }
-
-                # Добавляем курсор для пагинации (кроме первого запроса)
-                if cursor:
-                    payload["settings"]["cursor"] = {
-                        "updatedAt": cursor["updatedAt"],
-                        "nmID": cursor["nmID"]
-                    }
-
-                # Отправляем запрос
-                async with session.post(url, json=payload, timeout=30) as response:
-                    request_count += 1
-
-                    # Обработка ошибок
-                    if response.status != 200:
-                        print(f"Ошибка {response.status}: {await response.text()}")
-                        if response.status == 429:
-                            reset_time = 70
-                            print(f"Лимит запросов. Пауза {reset_time} сек.")
-                            await asyncio.sleep(reset_time)
-                            continue
-                        return None
-
-                    data = await response.json()
-
-                    # Обработка каждой карточки
-                    for card in data.get("cards", []):
-                        all_cards.append({
-                            "vendorCode": card.get("vendorCode"),
-                            "nmID": card.get("nmID")
-                        })
-
-                    # Проверка завершения пагинации
-                    cursor = data.get("cursor")
-                    if not cursor or cursor.get("total", 0) < 100:
-                        break
-
-                    # Контроль лимита запросов (100/мин)
-                    elapsed_time = time.time() - start_time
-                    if request_count >= 100 and elapsed_time < 60:
-                        sleep_time = 60 - elapsed_time + 1
-                        print(
-                            f"Приближение к лимиту запросов. Пауза {sleep_time:.1f} сек.")
-                        await asyncio.sleep(sleep_time)
-                        request_count = 0
-                        start_time = time.time()
+        for i in range(1000):
+            data, limit = await fetch_cards_page(headers, cursor)
+            if data is None:
+                return None
+
+            # Обработка каждой карточки
+            for card in data.get("cards", []):
+                all_cards.append({
+                    "vendorCode": card.get("vendorCode"),
+                    "nmID": card.get("nmID")
+                })
+
+            # Проверка завершения пагинации
+            cursor = data.get("cursor")
+            if not cursor or cursor.get("total", 0) < limit:
+                break
 
     except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"Ошибка соединения: {e}")
@@ -151,100 +204,346 @@ async def get_wb_product_cards(headers):
     print(f"Получено карточек: {len(all_cards)}")
     return all_cards
 
-async def get_orders_statistics(headers, nm_ids, date_from=None, date_to=None, state=None):
-    """Возвращает статистику с возможностью возобновления обработки"""
-    API_URL = "https://seller-analytics-api.wildberries.ru/api/v2/nm-report/detail/history"
-    
+# Количество одновременных запросов к nm-report по одному ключу
+ORDERS_WORKERS = 3
+# Максимальная длина периода в одном запросе детальной истории
+ORDERS_MAX_DAYS = 7
+# Насколько глубоко в прошлое детальная история отдаёт данные, дней
+ORDERS_HISTORY_DAYS = 7
+# Сколько 429 подряд допускается, прежде чем вернуть состояние вызывающему
+ORDERS_MAX_RETRIES = 5
+# Сколько сетевых ошибок подряд допускается, прежде чем загрузка прерывается
+ORDERS_MAX_FAILURES = 5
+DETAIL_URL = f"{ANALYTICS_API}/api/v2/nm-report/detail/history"
+# Поля статистики заказов по артикулу (см. WB_stats.NmStats)
+ORDER_FIELDS = (('ordersCount', 'q'), ('ordersSumRub', 'd'),
+                ('addToCartConversion', 'd'), ('cartToOrderConversion', 'd'))
+
+
+def new_stats(per_day=False):
+    """Пустая статистика заказов: NmStats или {дата: NmStats} при per_day"""
+    return {} if per_day else NmStats(ORDER_FIELDS)
+
+
+def orders_history_start():
+    """Самый ранний день ('YYYY-MM-DD'), за который detail/history отдаёт заказы"""
+    return (datetime.now() - timedelta(days=ORDERS_HISTORY_DAYS)).strftime('%Y-%m-%d')
+
+
+def add_history_item(stats, item, per_day=False):
+    """Добавляет в stats историю одной карточки из ответа detail/history"""
+    nm_id = item["nmID"]
+    if per_day:
+        for day in item.get("history", []):
+            date = day["dt"][:10]
+            if date not in stats:
+                stats[date] = NmStats(ORDER_FIELDS)
+            stats[date].add(nm_id, (
+                day.get("ordersCount", 0),
+                day.get("ordersSumRub", 0),
+                day.get("addToCartConversion", 0),
+                day.get("cartToOrderConversion", 0)
+            ))
+        return
+    orders_count = 0
+    orders_sum = 0.0
+    addToCartConversion = 0.0
+    cartToOrderConversion = 0.0
+    for day in item.get("history", []):
+        orders_count += day.get("ordersCount", 0)
+        orders_sum += day.get("ordersSumRub", 0)
+        addToCartConversion += day.get("addToCartConversion", 0)
+        cartToOrderConversion += day.get("cartToOrderConversion", 0)
+    stats.add(nm_id, (orders_count, orders_sum, addToCartConversion, cartToOrderConversion))
+
+
+async def request_orders_chunk(headers, chunk, date_from, date_to, per_day=False):
+    """
+    Запрашивает историю по одному чанку nmID
+
+    :param per_day: Не суммировать дни, а вернуть статистику по каждому дню
+    :return: (200, NmStats) при успехе ({дата: NmStats} при per_day),
+             (429, пауза) при лимите, ('transport', None) при
+             таймауте, сетевой ошибке, 5xx или разомкнутом выключателе,
+             (код ошибки, None) при прочих ошибках
+
+    Ответы за закрытые дни берутся из локального кэша без обращения к WB.
+    Время и размер ответа, а также сетевые ошибки учитываются в размере
+    чанка для ключа (WB_limits.get_sizer).
+    """
+    API_URL = DETAIL_URL
+    payload = {
+        "nmIDs": chunk,
+        "period": {"begin": date_from, "end": date_to},
+        "timezone": "Europe/Moscow",
+        "aggregationLevel": "day"
+    }
+    cache_entry = cache_key(headers, API_URL, payload) if is_immutable(date_to) else None
+    if cache_entry:
+        cached = get_cached(cache_entry)
+        if cached is not None:
+            try:
+                stats = new_stats(per_day)
+                for item in items_from_bytes(cached, 'data.item'):
+                    add_history_item(stats, item, per_day)
+                return 200, stats
+            except JSON_ERRORS + (KeyError,) as e:
+                logging.error(f"Повреждённая запись кэша: {e}")
+
+    breaker = get_breaker(API_URL)
+    if not breaker.allow():
+        logging.warning(f"WB API {breaker.host} недоступен, чанк отложен")
+        return 'transport', None
+
+    sizer = get_sizer(headers, API_URL)
+    await acquire(headers, API_URL)
+    try:
+        session = get_session(API_URL)
+        started = time.monotonic()
+        async with session.post(
+            API_URL,
+            headers=headers,
+            json=payload,
+            timeout=30
+        ) as response:
+            observe_response(API_URL, response.status, time.monotonic() - started)
+            breaker.record_response(response.status)
+            if response.status == 200:
+                # Разбираем ответ потоково: в памяти только итоговые суммы
+                writer = CacheWriter(cache_entry) if cache_entry else None
+                received = 0
+
+                def tee(part):
+                    nonlocal received
+                    received += len(part)
+                    if writer:
+                        writer.write(part)
+
+                stats = new_stats(per_day)
+                async for item in iter_json_items(response, 'data.item', tee=tee):
+                    add_history_item(stats, item, per_day)
+                if writer:
+                    writer.commit()
+                sizer.record_success(len(chunk), time.monotonic() - started, received)
+                return 200, stats
+
+            if response.status == 429:
+                retry_after = get_retry_after(response.headers, 30)
+                logging.warning(f"429 error. Retry after: {retry_after}")
+                penalize(headers, API_URL, retry_after)
+                return 429, retry_after
+
+            logging.error(f"Error {response.status}: {await response.text()}")
+            if response.status >= 500:
+                sizer.record_failure(len(chunk))
+                return 'transport', None
+            return response.status, None
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Request error: {e}")
+        observe_error(API_URL, e)
+        breaker.record_failure()
+        sizer.record_failure(len(chunk))
+        return 'transport', None
+    except JSON_ERRORS as e:
+        logging.error(f"Request error: {e}")
+        return None, None
+
+
+async def get_orders_statistics(headers, nm_ids, date_from=None, date_to=None, state=None, on_progress=None, per_day=False):
+    """
+    Возвращает статистику с возможностью возобновления обработки
+
+    Очередь nmID в state['pending'] разбирает пул из ORDERS_WORKERS задач.
+    Каждая берёт чанк размера, подобранного для ключа (не больше 20 nmID,
+    см. WB_limits.get_sizer); полученные nmID из очереди уходят и повторно не
+    запрашиваются. Чанк, получивший 429, откладывается в конец очереди, после
+    таймаута или сетевой ошибки — возвращается в начало и уходит уже
+    меньшими частями. on_progress(done, total) вызывается после каждого
+    чанка (в nmID). Результат — NmStats с полями ORDER_FIELDS, при per_day —
+    {дата: NmStats}.
+
+    Если лимит не отпускает дольше ORDERS_MAX_RETRIES попыток, возвращается
+    {'error': 429, 'retry_after', 'state'}, после ORDERS_MAX_FAILURES сетевых
+    ошибок подряд — {'error': 'transport', 'state'}; state продолжает загрузку.
+    """
     # Инициализация состояния
     if state is None:
         state = {
-            'chunks': [nm_ids[i:i + 20] for i in range(0, len(nm_ids), 20)],
-            'all_stats': {},
-            'current_chunk': 0,
-            'retry_count': 0
-        }
-    
-    # Обрабатываем чанки по очереди
-    while state['current_chunk'] < len(state['chunks']):
-        chunk = state['chunks'][state['current_chunk']]
-        payload = {
-            "nmIDs": chunk,
-            "period": {"begin": date_from, "end": date_to},
-            "timezone": "Europe/Moscow",
-            "aggregationLevel": "day"
+            'pending': deque(nm_ids),
+            'total': len(nm_ids),
+            'done': 0,
+            'all_stats': new_stats(per_day),
+            'retry_count': 0,
+            'failures': 0
         }
-        await asyncio.sleep(0.2)
-        try:
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.post(
-                    API_URL,
-                    json=payload,
-                    timeout=30
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        for item in data.get("data", []):
-                            nm_id = item["nmID"]
-                            orders_count = 0
-                            orders_sum = 0.0
-                            addToCartConversion = 0.0
-                            cartToOrderConversion = 0.0
-                            for day in item.get("history", []):
-                                orders_count += day.get("ordersCount", 0)
-                                orders_sum += day.get("ordersSumRub", 0)
-                                addToCartConversion += day.get("addToCartConversion", 0)
-                                cartToOrderConversion += day.get("cartToOrderConversion", 0)
-                            state['all_stats'][nm_id] = {
-                                "ordersCount": orders_count,
-                                "ordersSumRub": orders_sum,
-                                "addToCartConversion": addToCartConversion,
-                                "cartToOrderConversion": cartToOrderConversion
-                            }
-                        
-                        # Переходим к следующему чанку
-                        state['current_chunk'] += 1
-                        state['retry_count'] = 0  # Сбрасываем счетчик повторов
-
-                    elif response.status == 429:
-                        retry_after = 30
-                        logging.warning(f"429 error. Retry after: {retry_after}")
-                        
-                        # Увеличиваем счетчик повторов
-                        state['retry_count'] += 1
-                        if state['retry_count'] > 5:
-                            logging.error("Max retries exceeded")
-                            return {
-                                'error': 429,
-                                'retry_after': retry_after,
-                                'state': state
-                            }
-                        
-                        # Возвращаем текущее состояние для возобновления
-                        return {
-                            'error': 429,
-                            'retry_after': retry_after,
-                            'state': state
-                        }
 
+    sizer = get_sizer(headers, DETAIL_URL)
+    pending = state['pending']
+    total = state['total']
+    rate_limited = {}
+    unavailable = []
+
+    async def worker():
+        while pending and not rate_limited and not unavailable:
+            chunk = [pending.popleft() for _ in range(min(sizer.size, len(pending)))]
+            status, result = await request_orders_chunk(
+                headers, chunk, date_from, date_to, per_day)
+
+            if status == 429:
+                # Откладываем только этот чанк
+                pending.extend(chunk)
+                state['retry_count'] += 1
+                if state['retry_count'] > ORDERS_MAX_RETRIES:
+                    logging.error("Max retries exceeded")
+                    rate_limited['retry_after'] = result
+                continue
+
+            if status == 'transport':
+                state['failures'] += 1
+                # Размер чанка уже уменьшен: эти nmID уйдут меньшими частями
+                pending.extendleft(reversed(chunk))
+                if state['failures'] >= ORDERS_MAX_FAILURES:
+                    logging.error(f"Загрузка заказов остановлена после {state['failures']} сетевых ошибок")
+                    unavailable.append(True)
+                continue
+
+            # При прочих ошибках чанк пропускается, как и раньше
+            if status == 200 and per_day:
+                for date, day_stats in result.items():
+                    if date in state['all_stats']:
+                        state['all_stats'][date].update(day_stats)
                     else:
-                        logging.error(f"Error {response.status}: {await response.text()}")
-                        # Переходим к следующему чанку при других ошибках
-                        state['current_chunk'] += 1
-                        state['retry_count'] = 0
+                        state['all_stats'][date] = day_stats
+            elif status == 200:
+                state['all_stats'].update(result)
+            state['done'] += len(chunk)
+            state['retry_count'] = 0  # Сбрасываем счетчик повторов
+            state['failures'] = 0
 
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            logging.error(f"Request error: {e}")
-            state['current_chunk'] += 1
-            state['retry_count'] = 0
+            if on_progress:
+                progress = on_progress(state['done'], total)
+                if asyncio.iscoroutine(progress):
+                    await progress
+
+    with span('orders.chunks', nm_ids=total, pending=len(pending)):
+        await asyncio.gather(*(worker() for _ in range(min(ORDERS_WORKERS, len(pending)))))
+
+    if rate_limited:
+        # Возвращаем текущее состояние для возобновления
+        state['retry_count'] = 0
+        return {
+            'error': 429,
+            'retry_after': rate_limited['retry_after'],
+            'state': state
+        }
+
+    if unavailable:
+        state['failures'] = 0
+        return {
+            'error': 'transport',
+            'state': state
+        }
 
     return state['all_stats']
 
-async def get_dict_orders(headers, date, state=None, cards=None):
-    """Возвращает статистику по заказам с возможностью возобновления"""
+def dump_orders_state(state):
+    """Состояние get_orders_statistics (per_day=False) в виде, пригодном для JSON"""
+    if state is None:
+        return None
+    return {
+        'pending': list(state['pending']),
+        'total': state['total'],
+        'done': state['done'],
+        'all_stats': state['all_stats'].dump(),
+    }
+
+
+def load_orders_state(data):
+    """Обратное к dump_orders_state (состояние прежнего формата не восстанавливается)"""
+    if not data or not isinstance(data['all_stats'], dict):
+        return None
+    return {
+        'pending': deque(data['pending']),
+        'total': data['total'],
+        'done': data['done'],
+        'all_stats': NmStats.load(data['all_stats'], ORDER_FIELDS),
+        'retry_count': 0,
+        'failures': 0
+    }
+
+
+SUPPLIER_ORDERS_URL = f"{STATISTICS_API}/api/v1/supplier/orders"
+
+
+class ActiveNmIds:
+    """Приёмник строк ленты заказов: nmID с заказами и общее число заказов"""
+
+    def __init__(self):
+        self.nm_ids = set()
+        self.orders = 0
+
+    def add(self, row):
+        self.nm_ids.add(row['nmId'])
+        self.orders += 1
+
+
+async def get_active_nm_ids(headers, date):
+    """
+    Предварительный отбор: nmID, у которых были заказы за день
+
+    Лента заказов (/api/v1/supplier/orders, flag=1 — все заказы за дату)
+    отдаёт весь день одним запросом, тогда как detail/history принимает
+    не больше 20 nmID за запрос. Лента обновляется раз в 30 минут и может
+    отставать от nm-report, поэтому её полнота сверяется с общим числом
+    заказов за день из grouped/history.
+
+    :return: множество nmID или None, если ленте нельзя доверять
+             (тогда запрашивается весь каталог)
+    """
+    feed = await safe_request(headers, SUPPLIER_ORDERS_URL, params={'dateFrom': date, 'flag': 1},
+                              items=ActiveNmIds, cache_date=date)
+    if not isinstance(feed, ActiveNmIds):
+        logging.warning(f"Лента заказов за {date} недоступна, запрашивается весь каталог")
+        return None
+
+    grouped = await get_wb_grouped_stats(date, headers)
+    if grouped is None:
+        # Без сверки лента может оказаться неполной
+        return None
+    expected = sum(day.get('ordersCount', 0) for day in grouped)
+    if feed.orders < expected:
+        logging.warning(f"Лента заказов за {date} неполная ({feed.orders} из {expected}), "
+                        f"запрашивается весь каталог")
+        return None
+    return feed.nm_ids
+
+
+async def get_dict_orders(headers, date, state=None, cards=None, on_progress=None):
+    """
+    Возвращает статистику по заказам с возможностью возобновления
+
+    За закрытый день в detail/history уходят только nmID с заказами
+    (get_active_nm_ids): карточки без заказов всё равно отбрасываются при
+    расчёте метрик. За текущий день лента заказов обычно отстаёт от
+    nm-report, а её лимит (1 запрос в минуту) задерживал бы отчёты бота,
+    поэтому запрашивается весь каталог.
+    """
     if not cards:
         cards = await get_wb_product_cards(headers)
+    if cards is None:
+        # Карточки не получены — это сбой WB, а не пустой каталог
+        return {'error': 'transport', 'state': None}
     if not cards:
-        return {}
+        return new_stats()
     
     nm_ids = [product['nmID'] for product in cards]
-    return await get_orders_statistics(headers, nm_ids, date, date, state)
\ No newline at end of file
+    if state is None and date[:10] < datetime.now().strftime('%Y-%m-%d'):
+        with span('orders.prefilter', catalog=len(nm_ids)) as stage:
+            active = await get_active_nm_ids(headers, date)
+            if active is not None:
+                # Заказанные карточки, которых ещё нет в каталоге, тоже запрашиваются
+                known = set(nm_ids)
+                nm_ids = [nm_id for nm_id in nm_ids if nm_id in active] + sorted(active - known)
+            stage.set(active=len(nm_ids) if active is not None else None)
+    return await get_orders_statistics(headers, nm_ids, date, date, state, on_progress)
\ No newline at end of file
@@ -0,0 +1,306 @@
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+from aiohttp import web
+from WB_limits import LIMITS, ENDPOINT_FAMILIES
+
+# Локальная замена WB API для нагрузочных и регрессионных проверок.
+# Запуск: python WB_simulator.py --port 8080 --cards 5000
+# Бот и отчёты направляются на него переменной окружения
+# WB_API_BASE=http://127.0.0.1:8080
+
+# Ограничения WB на размер запросов
+FULLSTATS_MAX_CAMPAIGNS = 100
+FULLSTATS_MAX_DAYS = 31
+DETAIL_MAX_NMS = 20
+CARDS_MAX_LIMIT = 100
+# На сколько групп (предметов) делится ответ grouped/history
+GROUPED_GROUPS = 3
+
+
+class Simulator:
+    """Синтетический кабинет WB и настройки отказов"""
+
+    def __init__(self, cards=1000, campaigns=50, nms_per_campaign=5, latency=0.0,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=5,
+                 enforce_limits=False, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.enforce_limits = enforce_limits
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        # Каталог: nmID, артикул и время изменения карточки
+        start = datetime(2024, 1, 1)
+        self.cards = [{
+            "nmID": 100000 + i,
+            "vendorCode": f"ART-{i}",
+            "updatedAt": (start + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        } for i in range(cards)]
+        nm_ids = [card["nmID"] for card in self.cards]
+
+        # Кампании трёх видов: автоматические, аукцион и старый формат params
+        self.campaigns = {}
+        for i in range(campaigns):
+            advert_id = 1000 + i
+            nms = self.rng.sample(nm_ids, min(nms_per_campaign, len(nm_ids)))
+            campaign = {"advertId": advert_id, "type": 8 if i % 3 == 0 else 9, "status": 9,
+                        "createTime": "2024-01-01T00:00:00+03:00"}
+            if i % 3 == 0:
+                campaign["autoParams"] = {"nms": nms}
+            elif i % 3 == 1:
+                campaign["unitedParams"] = [{"nms": nms}]
+            else:
+                campaign["params"] = [{"nms": [{"nm": nm} for nm in nms]}]
+            campaign["_nms"] = nms
+            self.campaigns[advert_id] = campaign
+
+        # Корзины лимитов: {(ключ, семейство): (токены, время)}
+        self.buckets = {}
+        # Счётчики для проверки нагрузки
+        self.requests = Counter()
+        self.faults = Counter()
+
+    def _day_rng(self, *parts):
+        """Детерминированный генератор для дня и артикула"""
+        return random.Random(":".join(str(part) for part in (self.seed,) + parts))
+
+    def day_orders(self, nm_id, date):
+        rng = self._day_rng("orders", nm_id, date)
+        orders = rng.choice((0, 0, 1, 2, 3, 5, 8))
+        return {
+            "dt": date,
+            "openCardCount": orders * rng.randint(10, 40),
+            "addToCartCount": orders * rng.randint(2, 5),
+            "ordersCount": orders,
+            "ordersSumRub": round(orders * rng.uniform(300, 3000), 2),
+            "buyoutsCount": rng.randint(0, orders),
+            "buyoutsSumRub": 0,
+            "buyoutPercent": 0,
+            "addToCartConversion": rng.randint(0, 30),
+            "cartToOrderConversion": rng.randint(0, 60)
+        }
+
+    def day_ads(self, advert_id, nm_id, date):
+        rng = self._day_rng("ads", advert_id, nm_id, date)
+        views = rng.randint(0, 2000)
+        clicks = rng.randint(0, max(views // 20, 1))
+        return {"nmId": nm_id, "views": views, "clicks": clicks,
+                "sum": round(clicks * rng.uniform(5, 25), 2), "name": ""}
+
+    def _wait_for_token(self, key, path):
+        """Сколько ждать до следующего разрешённого запроса (0 — можно сейчас)"""
+        family = ENDPOINT_FAMILIES.get(path, 'default')
+        interval, burst = LIMITS[family]
+        now = time.monotonic()
+        tokens, updated = self.buckets.get((key, family), (float(burst), now))
+        tokens = min(burst, tokens + (now - updated) / interval)
+        if tokens < 1:
+            self.buckets[(key, family)] = (tokens, now)
+            return (1 - tokens) * interval
+        self.buckets[(key, family)] = (tokens - 1, now)
+        return 0
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        path = request.path
+        if path.startswith("/simulator/"):
+            return await handler(request)
+        self.requests[path] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+
+        key = request.headers.get("Authorization")
+        if not key:
+            return web.json_response({"title": "unauthorized"}, status=401)
+
+        if self.rng.random() < self.error_rate:
+            self.faults["5xx"] += 1
+            return web.json_response({"title": "internal error"}, status=self.rng.choice((500, 502, 503)))
+
+        wait = self._wait_for_token(key, path) if self.enforce_limits else 0
+        if not wait and self.rng.random() < self.rate_limit_rate:
+            wait = self.retry_after
+        if wait:
+            self.faults["429"] += 1
+            return web.json_response({"title": "too many requests"}, status=429, headers={
+                "X-Ratelimit-Retry": str(round(wait, 2)),
+                "X-Ratelimit-Reset": str(round(wait, 2)),
+                "X-Ratelimit-Remaining": "0"
+            })
+
+        return await handler(request)
+
+    # --- Обработчики эндпоинтов ---
+
+    async def ping(self, request):
+        return web.json_response({"TS": datetime.now().isoformat(), "Status": "OK"})
+
+    async def promotion_count(self, request):
+        groups = {}
+        for campaign in self.campaigns.values():
+            groups.setdefault(campaign["type"], []).append(
+                {"advertId": campaign["advertId"], "changeTime": campaign["createTime"]})
+        return web.json_response({
+            "adverts": [{"type": advert_type, "status": 9, "count": len(advert_list), "advert_list": advert_list}
+                        for advert_type, advert_list in groups.items()],
+            "all": len(self.campaigns)
+        })
+
+    async def promotion_adverts(self, request):
+        ids = await request.json()
+        if not isinstance(ids, list) or len(ids) > 50:
+            return web.json_response({"error": "invalid ids"}, status=400)
+        return web.json_response([
+            {k: v for k, v in self.campaigns[advert_id].items() if not k.startswith("_")}
+            for advert_id in ids if advert_id in self.campaigns
+        ])
+
+    async def fullstats(self, request):
+        body = await request.json()
+        if not isinstance(body, list) or len(body) > FULLSTATS_MAX_CAMPAIGNS:
+            return web.json_response({"error": "too many campaigns"}, status=400)
+        result = []
+        for item in body:
+            campaign = self.campaigns.get(item.get("id"))
+            dates = item.get("dates") or []
+            if len(dates) > FULLSTATS_MAX_DAYS:
+                return web.json_response({"error": "too many dates"}, status=400)
+            if not campaign:
+                continue
+            days = [{
+                "date": f"{date}T00:00:00+03:00",
+                "apps": [{"appType": 1, "nm": [self.day_ads(campaign["advertId"], nm, date)
+                                                for nm in campaign["_nms"]]}]
+            } for date in dates]
+            result.append({"advertId": campaign["advertId"], "days": days})
+        if not result:
+            return web.Response(text='{"error":"no companies with correct intervals"}', status=400)
+        return web.json_response(result)
+
+    def _period_days(self, period):
+        start = datetime.strptime(period["begin"][:10], "%Y-%m-%d")
+        end = datetime.strptime(period["end"][:10], "%Y-%m-%d")
+        return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+
+    async def detail_history(self, request):
+        body = await request.json()
+        nm_ids = body.get("nmIDs") or []
+        if len(nm_ids) > DETAIL_MAX_NMS:
+            return web.json_response({"error": True, "errorText": "too many nmIDs"}, status=400)
+        days = self._period_days(body["period"])
+        vendor_codes = {card["nmID"]: card["vendorCode"] for card in self.cards}
+        return web.json_response({
+            "data": [{"nmID": nm_id, "vendorCode": vendor_codes[nm_id],
+                      "history": [self.day_orders(nm_id, date) for date in days]}
+                     for nm_id in nm_ids if nm_id in vendor_codes],
+            "error": False,
+            "errorText": ""
+        })
+
+    async def grouped_history(self, request):
+        body = await request.json()
+        # Как и WB, ответ делится на группы (здесь — по GROUPED_GROUPS предметам)
+        groups = []
+        for group in range(GROUPED_GROUPS):
+            history = []
+            for date in self._period_days(body["period"]):
+                day = Counter()
+                for card in self.cards[group::GROUPED_GROUPS]:
+                    day.update({k: v for k, v in self.day_orders(card["nmID"], date).items() if k != "dt"})
+                history.append({**day, "dt": date})
+            groups.append({"history": history})
+        return web.json_response({"data": groups, "error": False, "errorText": ""})
+
+    async def supplier_orders(self, request):
+        """Лента заказов: строка на каждую заказанную единицу за день (flag=1)"""
+        date = request.query.get("dateFrom", "")[:10]
+        if request.query.get("flag") != "1" or not date:
+            return web.json_response({"errors": ["only flag=1 is simulated"]}, status=400)
+        rows = []
+        for card in self.cards:
+            for _ in range(self.day_orders(card["nmID"], date)["ordersCount"]):
+                rows.append({"date": f"{date}T12:00:00", "nmId": card["nmID"],
+                             "supplierArticle": card["vendorCode"], "isCancel": False})
+        return web.json_response(rows)
+
+    async def cards_list(self, request):
+        settings = (await request.json()).get("settings", {})
+        cursor = settings.get("cursor", {})
+        limit = min(cursor.get("limit", CARDS_MAX_LIMIT), CARDS_MAX_LIMIT)
+        ascending = settings.get("sort", {}).get("ascending", False)
+
+        cards = sorted(self.cards, key=lambda card: (card["updatedAt"], card["nmID"]), reverse=not ascending)
+        if cursor.get("updatedAt"):
+            position = (cursor["updatedAt"], cursor["nmID"])
+            if ascending:
+                cards = [card for card in cards if (card["updatedAt"], card["nmID"]) > position]
+            else:
+                cards = [card for card in cards if (card["updatedAt"], card["nmID"]) < position]
+        page = cards[:limit]
+        next_cursor = {"total": len(page)}
+        if page:
+            next_cursor.update({"updatedAt": page[-1]["updatedAt"], "nmID": page[-1]["nmID"]})
+        return web.json_response({"cards": page, "cursor": next_cursor})
+
+    async def stats(self, request):
+        """Счётчики запросов и внесённых отказов"""
+        return web.json_response({"requests": dict(self.requests), "faults": dict(self.faults)})
+
+
+def create_app(simulator):
+    app = web.Application(middlewares=[simulator.middleware])
+    app.router.add_get("/ping", simulator.ping)
+    app.router.add_get("/adv/v1/promotion/count", simulator.promotion_count)
+    app.router.add_post("/adv/v1/promotion/adverts", simulator.promotion_adverts)
+    app.router.add_post("/adv/v2/fullstats", simulator.fullstats)
+    app.router.add_post("/api/v2/nm-report/detail/history", simulator.detail_history)
+    app.router.add_post("/api/v2/nm-report/grouped/history", simulator.grouped_history)
+    app.router.add_post("/content/v2/get/cards/list", simulator.cards_list)
+    app.router.add_get("/api/v1/supplier/orders", simulator.supplier_orders)
+    app.router.add_get("/simulator/stats", simulator.stats)
+    return app
+
+
+async def start_simulator(simulator, host="127.0.0.1", port=8080):
+    """Запускает симулятор в текущем цикле событий (для скриптов и замеров)"""
+    runner = web.AppRunner(create_app(simulator))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Симулятор WB API: http://{host}:{port}")
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный симулятор WB API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cards", type=int, default=1000, help="Число карточек в каталоге")
+    parser.add_argument("--campaigns", type=int, default=50, help="Число рекламных кампаний")
+    parser.add_argument("--nms-per-campaign", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="Средняя задержка ответа, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 5xx")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля случайных ответов 429")
+    parser.add_argument("--retry-after", type=float, default=5, help="Пауза в заголовках случайных 429, сек")
+    parser.add_argument("--enforce-limits", action="store_true", help="Отвечать 429 при превышении лимитов WB")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = Simulator(
+        cards=args.cards, campaigns=args.campaigns, nms_per_campaign=args.nms_per_campaign,
+        latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after, enforce_limits=args.enforce_limits, seed=args.seed
+    )
+    web.run_app(create_app(simulator), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
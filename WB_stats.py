@@ -0,0 +1,75 @@
+from array import array
+import numpy as np
+import pandas as pd
+
+# Статистика по артикулам хранится колонками: номер nmID и по типизированному
+# массиву на поле. Вместо тысяч словарей с повторяющимися ключами на артикул
+# приходится по 8 байт на поле, а в DataFrame колонки переходят без обхода.
+# Поля задаются парами (имя, код типа array): 'q' — целое, 'd' — дробное.
+
+
+class NmStats:
+    """Статистика по nmID в типизированных колонках"""
+
+    __slots__ = ('fields', 'nm_ids', 'columns')
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.nm_ids = array('q')
+        self.columns = [array(typecode) for _, typecode in self.fields]
+
+    def __len__(self):
+        return len(self.nm_ids)
+
+    def __iter__(self):
+        return iter(self.nm_ids)
+
+    @property
+    def names(self):
+        return [name for name, _ in self.fields]
+
+    def add(self, nm_id, values):
+        """Добавляет строку nmID; values — значения полей по порядку"""
+        self.nm_ids.append(nm_id)
+        for column, (_, typecode), value in zip(self.columns, self.fields, values):
+            column.append(int(value) if typecode == 'q' else float(value))
+
+    def update(self, other):
+        """Дописывает строки other (при повторе nmID действует последняя строка)"""
+        self.nm_ids.extend(other.nm_ids)
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+
+    def to_frame(self):
+        """DataFrame с индексом nmId и колонками полей"""
+        # Копии, а не представления: иначе массивы нельзя было бы дополнять
+        nm_ids = np.array(self.nm_ids, dtype=np.int64)
+        data = {name: np.array(column, dtype=np.int64 if typecode == 'q' else np.float64)
+                for column, (name, typecode) in zip(self.columns, self.fields)}
+        frame = pd.DataFrame(data, index=pd.Index(nm_ids, name='nmId'))
+        if frame.index.has_duplicates:
+            frame = frame[~frame.index.duplicated(keep='last')]
+        return frame
+
+    @classmethod
+    def from_frame(cls, frame, fields):
+        """Строки DataFrame с индексом nmId (колонки — имена полей)"""
+        stats = cls(fields)
+        stats.nm_ids = array('q', frame.index.to_numpy(dtype=np.int64).tobytes())
+        stats.columns = [array(typecode, frame[name].to_numpy(
+            dtype=np.int64 if typecode == 'q' else np.float64).tobytes())
+            for name, typecode in stats.fields]
+        return stats
+
+    def dump(self):
+        """Вид, пригодный для JSON"""
+        return {'nm_ids': self.nm_ids.tolist(), 'columns': {
+            name: column.tolist() for column, (name, _) in zip(self.columns, self.fields)}}
+
+    @classmethod
+    def load(cls, data, fields):
+        """Обратное к dump"""
+        stats = cls(fields)
+        stats.nm_ids = array('q', data['nm_ids'])
+        stats.columns = [array(typecode, data['columns'][name]) for name, typecode in stats.fields]
+        return stats
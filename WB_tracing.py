@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import uuid
+import logging
+import contextvars
+from datetime import datetime
+
+# Трассировка этапов отчёта: одна трасса на нажатие кнопки в Telegram или на
+# кабинет ночного отчёта, внутри — вложенные интервалы этапов. Завершённая
+# трасса дописывается в TRACE_FILE строками JSON (по строке на интервал).
+# Пустое значение WB_TRACE_FILE отключает запись.
+TRACE_FILE = os.getenv("WB_TRACE_FILE", "traces.jsonl")
+
+# Текущий интервал; задачи asyncio наследуют его при создании
+_current = contextvars.ContextVar('wb_span', default=None)
+
+
+class Trace:
+    """Интервалы одной трассы, записываемые вместе после её завершения"""
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.finished = False
+
+    def add(self, record):
+        if self.finished:
+            # Интервал задачи, пережившей корень трассы, пишется отдельно
+            write_records([record])
+        else:
+            self.spans.append(record)
+
+    def finish(self):
+        self.finished = True
+        records, self.spans = self.spans, []
+        write_records(records)
+
+
+class Span:
+    """Интервал этапа; используется как контекстный менеджер"""
+
+    def __init__(self, name, attrs, root=False):
+        self.name = name
+        self.attrs = attrs
+        self.parent = None if root else _current.get()
+        self.trace = self.parent.trace if self.parent else Trace()
+        self.span_id = uuid.uuid4().hex[:16]
+        self.token = None
+
+    def set(self, **attrs):
+        """Добавляет атрибуты, известные только по ходу этапа"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _current.reset(self.token)
+        record = {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'name': self.name,
+            'start': self.started_at.isoformat(timespec='milliseconds'),
+            'duration_ms': round(duration * 1000, 1),
+            'attrs': self.attrs,
+        }
+        if exc_type is not None:
+            record['error'] = f"{exc_type.__name__}: {exc}"
+        self.trace.add(record)
+        if self.parent is None:
+            self.trace.finish()
+        return False
+
+
+def trace(name, **attrs):
+    """Начинает новую трассу (корневой интервал) независимо от текущей"""
+    return Span(name, attrs, root=True)
+
+
+def span(name, **attrs):
+    """Интервал этапа внутри текущей трассы (или новая трасса, если её нет)"""
+    return Span(name, attrs)
+
+
+def current_span():
+    return _current.get()
+
+
+def write_records(records):
+    if not TRACE_FILE or not records:
+        return
+    try:
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n'
+                            for record in records))
+    except OSError as e:
+        logging.error(f"Ошибка записи трассировки {TRACE_FILE}: {e}")
@@ -1,34 +1,70 @@
 import gspread
 import asyncio
 import pandas as pd
+from yarl import URL
 from datetime import datetime, timedelta
 from config import CONFIG_URL, CREDS
-from WB_ads import get_expenses_per_nm
-from WB_orders import get_dict_orders, get_wb_product_cards
+from WB_ads import get_expenses_per_nm, get_expenses_per_day, date_windows, dump_expenses_state, load_expenses_state, \
+    EXPENSE_FIELDS
+from WB_orders import get_dict_orders, get_orders_statistics, ORDERS_MAX_DAYS, dump_orders_state, load_orders_state, \
+    ORDER_FIELDS, orders_history_start
+from WB_stats import NmStats
+from WB_catalog import get_catalog_cards
+from WB_flight import single_flight
+from WB_http import STATISTICS_API, ANALYTICS_API, ADVERT_API, close_sessions, unavailable_hosts, WBError, WBRateLimitError
+from WB_metrics import sheets_operation, observe_sheets, observe_report, REPORT_TASKS
+from WB_tracing import trace, span
+from WB_jobs import get_job, save_job, queue_jobs, unfinished_dates, prune_jobs, dump_stats, load_stats, \
+    ORDERS, ADS, METRICS, WRITING, DONE
 import numpy as np
 import logging
+import json
+import time
+import os
 
 from asyncio import Semaphore
 semaphore = Semaphore(10)  # Максимум 10 задач
 
+# Догрузка истории идёт по одной и уступает ночному отчёту
+backfill_semaphore = Semaphore(1)
+nightly_idle = asyncio.Event()
+nightly_idle.set()
+nightly_running = 0
+# Отчёты кабинетов, выполняющиеся сейчас: {(пользователь, кабинет, дата)}
+running_jobs = set()
+
+# Файл с прогрессом догрузки по дням
+BACKFILL_FILE = "backfill_state.json"
+# Сколько раз догрузка продолжает прерванную загрузку рекламы
+BACKFILL_ADS_RETRIES = 3
+
 # Настройки WB API
-WB_STAT_URL = 'https://statistics-api.wildberries.ru/api/v1/supplier/'
+WB_STAT_URL = f'{STATISTICS_API}/api/v1/supplier/'
+# Хосты WB, без которых отчёт не построить (карточки берутся из каталога)
+REPORT_APIS = (ANALYTICS_API, ADVERT_API)
 HEADERS = {}
 
 # Глобальная переменная для API ключа WB
 WB_API_KEY = ""
 
 
+def wb_unavailable():
+    """Разомкнут ли выключатель хотя бы одного нужного отчёту хоста WB"""
+    hosts = unavailable_hosts()
+    return any(URL(url).host in hosts for url in REPORT_APIS)
+
+
 async def get_client_data(sheet_id, cabinet_name):
     try:
-        client = gspread.authorize(CREDS)
-        spreadsheet = client.open_by_key(sheet_id)
-        worksheet = spreadsheet.worksheet("Маржа")
+        with span('sheets.read_margin'), sheets_operation('read_margin'):
+            client = gspread.authorize(CREDS)
+            spreadsheet = client.open_by_key(sheet_id)
+            worksheet = spreadsheet.worksheet("Маржа")
 
-        # Получаем все данные за один запрос
-        records = worksheet.get_all_records(head=3,
-                                            value_render_option='UNFORMATTED_VALUE',
-                                            expected_headers=["Артикул WB", "Артикул продавца", "Прибыль с ед. товара",	"Выкупаемость (%)"])
+            # Получаем все данные за один запрос
+            records = worksheet.get_all_records(head=3,
+                                                value_render_option='UNFORMATTED_VALUE',
+                                                expected_headers=["Артикул WB", "Артикул продавца", "Прибыль с ед. товара",	"Выкупаемость (%)"])
 
         # Создаем словарь для быстрого поиска по артикулу
         data_dict = {}
@@ -47,100 +83,139 @@ async def get_client_data(sheet_id, cabinet_name):
         logging.error(f"Ошибка при получении данных из таблицы {sheet_id}: {e}")
         return {}
 
-async def calculate_metrics(orders, ad_stats_df, client_sheet_id, cabinet_name):
-    try:
-        # Получаем все данные из таблицы клиента одним запросом
+# Колонки дневного листа по порядку
+SHEET_COLUMNS = [
+    'Дата', 'Артикул WB', 'Артикул продавца', 'Количество заказов за период',
+    'Расходы на рекламу по артикулу', 'Сумма заказов', 'ДРР', 'Чистая прибыль за период по артикулу', ' ', 'Показы',
+    'CTR (Автоматические компании)', 'CTR (Аукционы)', 'Конверсия в корзину', 'Конверсия в заказ',
+]
+
+
+def orders_frame(orders):
+    """Заказы (NmStats с полями ORDER_FIELDS) -> DataFrame с индексом nmId"""
+    return orders.to_frame()
+
+
+def ads_frame(ad_stats, index):
+    """Расходы (NmStats с полями EXPENSE_FIELDS) по артикулам index; у артикулов без рекламы — NaN"""
+    return ad_stats.to_frame().astype(np.float64).reindex(index)
+
+
+def margin_frame(client_data, index):
+    """
+    Данные листа «Маржа» по артикулам index: артикул продавца, прибыль с
+    единицы и доля выкупа (NaN, если прибыль или выкупаемость не заполнены)
+    """
+    known = [nm_id for nm_id in index if nm_id in client_data]
+    filled = [nm_id for nm_id in known
+              if client_data[nm_id]['profit'] != '' and client_data[nm_id]['redemption'] != '']
+    vendor_codes = pd.Series([client_data[nm_id]['vendorCode'] for nm_id in known],
+                             index=pd.Index(known, dtype=np.int64), dtype=object)
+    margin = pd.DataFrame({
+        'profit_per_unit': [float(client_data[nm_id]['profit']) for nm_id in filled],
+        'redemption_rate': [float(client_data[nm_id]['redemption']) / 100 for nm_id in filled],
+    }, index=pd.Index(filled, dtype=np.int64), dtype=np.float64).reindex(index)
+    margin['vendorCode'] = vendor_codes.reindex(index).fillna('Нет в таблице')
+    return margin
+
+
+def round2(values):
+    """
+    Округление колонки до сотых так же, как встроенный round(): np.round
+    умножает на 100 и по-другому округляет половины (0.285 -> 0.29)
+    """
+    return values.map(lambda value: round(value, 2), na_action='ignore')
+
+
+def ctr(clicks, views):
+    """CTR в процентах по колонкам; 0 там, где не было показов"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = round2(clicks * 100 / views)
+    return values.where(views.fillna(0) != 0, 0.0)
+
+
+def metrics_frame(orders, ad_stats, client_data):
+    """
+    Канонические метрики кабинета по артикулам с заказами — общее ядро
+    дневного листа и отчёта бота (см. sheet_layout и bot_layout)
+
+    Заказы, реклама и данные листа «Маржа» выравниваются по nmId в колонки,
+    производные метрики считаются операциями над колонками целиком. Там, где
+    маржа не заполнена, прибыль — NaN.
+    """
+    frame = orders_frame(orders)
+    frame = frame[frame['ordersCount'] != 0]
+    ads = ads_frame(ad_stats, frame.index)
+    margin = margin_frame(client_data, frame.index)
+
+    frame['vendorCode'] = margin['vendorCode']
+    frame['costs'] = round2(ads['sum'].fillna(0.0))
+    frame['views'] = round2(ads['views'].fillna(0.0))
+    frame['auto_ctr'] = ctr(ads['auto_clicks'], ads['auto_views'])
+    frame['auction_ctr'] = ctr(ads['auction_clicks'], ads['auction_views'])
+    frame['gross_profit'] = round2(
+        margin['profit_per_unit'] * frame['ordersCount'] * margin['redemption_rate'])
+    # Разность и ДРР и раньше округлялись методом .round(2) скаляров numpy
+    frame['net_profit'] = np.round(frame['gross_profit'] - frame['costs'], 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['drr'] = np.round(frame['costs'] / frame['ordersSumRub'] * 100, 2)
+    return frame
+
+
+async def cabinet_metrics(orders, ad_stats, client_sheet_id, cabinet_name, client_data=None):
+    """metrics_frame с данными листа «Маржа» кабинета (читаются, если не переданы)"""
+    if client_data is None:
         client_data = {}
         if client_sheet_id:
             client_data = await get_client_data(client_sheet_id, cabinet_name)
-
-        for nmId in orders.keys():
-            if nmId in ad_stats_df:
-                orders[nmId]['costs'] = round(ad_stats_df[nmId]['sum'], 2)
-                orders[nmId]['views'] = round(ad_stats_df[nmId]['views'], 2)
-                
-                if ad_stats_df[nmId]['auto_views'] != 0:
-                    orders[nmId]['auto_ctr'] = round(ad_stats_df[nmId]['auto_clicks'] * 100 / ad_stats_df[nmId]['auto_views'], 2)                
-                else:
-                    orders[nmId]['auto_ctr'] = 0.0
-
-                if ad_stats_df[nmId]['auction_views'] != 0:
-                    orders[nmId]['auction_ctr'] = round(ad_stats_df[nmId]['auction_clicks'] * 100 / ad_stats_df[nmId]['auction_views'], 2)
-                else:
-                    orders[nmId]['auction_ctr'] = 0.0
-            else:
-                orders[nmId]['costs'] = 0.0
-                orders[nmId]['views'] = 0.0
-                orders[nmId]['auto_ctr'] = 0.0
-                orders[nmId]['auction_ctr'] = 0.0
-
-            if nmId in client_data:
-                if client_data[nmId]['profit'] != '' and client_data[nmId]['redemption'] != '':
-                    orders[nmId]['redemption_rate'] = float(client_data[nmId]['redemption']) / 100
-                    orders[nmId]['profit_per_unit'] = float(client_data[nmId]['profit'])
-
-                    # Расчёт прибыли
-                    orders[nmId]['gross_profit'] = round(orders[nmId]['profit_per_unit'] * orders[nmId]['ordersCount'] * orders[nmId]['redemption_rate'], 2)
-                else:
-                    orders[nmId]['redemption_rate'] = None
-                    orders[nmId]['profit_per_unit'] = None
-                    orders[nmId]['gross_profit']= None
-            else:
-                orders[nmId]['redemption_rate'] = None
-                orders[nmId]['profit_per_unit'] = None
-                orders[nmId]['gross_profit']= None
-        
-        result = []
-        for nmId, values in orders.items():
-            # print(nmId, values)
-            if values['ordersCount'] != 0:
-                if nmId in client_data:
-                    vendorCode = client_data[nmId]['vendorCode']
-                else:
-                    vendorCode = 'Нет в таблице'
-                result.append([nmId, vendorCode, values['ordersCount'], values['costs'], values['gross_profit'], values['ordersSumRub'], ' ', values['views'], values['auto_ctr'], values['auction_ctr'], values.get('addToCartConversion', 0), values.get('cartToOrderConversion', 0)])
-        result = pd.DataFrame(result, columns=['nmId', 'vendorCode', 'ordersCount', 'costs', 'gross_profit', 'ordersSumRub', 'void', 'views', 'auto_ctr', 'auction_ctr', 'addToCartConversion', 'cartToOrderConversion'])
-        for index, row in result.iterrows():
-            if pd.notna(result.at[index, 'costs']) and pd.notna(result.at[index, 'gross_profit']):
-                result.at[index, 'net_profit'] = (result.at[index, 'gross_profit'] -
-                                                  result.at[index, 'costs']).round(2)
-            else:
-                # print(index, result.at[index, 'gross_profit'], result.at[index, 'costs'])
-                result.at[index, 'net_profit'] = None
-            if pd.notna(result.at[index, 'costs']) and pd.notna(result.at[index, 'ordersSumRub']):
-                result.at[index, 'drr'] = (result.at[index, 'costs'] /
-                                           result.at[index, 'ordersSumRub'] * 100).round(2)
-            else:
-                result.at[index, 'drr'] = 0
-        result = result.rename(columns={
-            'nmId': 'Артикул WB',
-            'vendorCode': 'Артикул продавца',
-            'ordersCount': 'Количество заказов за период',
-            'costs': 'Расходы на рекламу по артикулу',
-            'ordersSumRub': 'Сумма заказов',
-            'drr': 'ДРР',
-            'net_profit': 'Чистая прибыль за период по артикулу',
-            'void': ' ',
-            'views': 'Показы',
-            'auto_ctr': 'CTR (Автоматические компании)',
-            'auction_ctr': 'CTR (Аукционы)',
-            'addToCartConversion': 'Конверсия в корзину',
-            'cartToOrderConversion': 'Конверсия в заказ'
-        })
-
-        result['Дата'] = (datetime.now() - timedelta(days=1)
-                          ).strftime('%d.%m.%Y')
-        # Заменяем None на строку "Нет данных"
-        for col in ['Чистая прибыль за период по артикулу']:
-            result[col] = result[col].apply(
-                lambda x: "ВНЕСИТЕ" if pd.isna(x) or x is None else x
-            )
-
-        return result[[
-            'Дата', 'Артикул WB', 'Артикул продавца', 'Количество заказов за период',
-            'Расходы на рекламу по артикулу', 'Сумма заказов', 'ДРР', 'Чистая прибыль за период по артикулу', ' ', 'Показы', 
-            'CTR (Автоматические компании)', 'CTR (Аукционы)', 'Конверсия в корзину', 'Конверсия в заказ', 
-        ]]
+    return metrics_frame(orders, ad_stats, client_data)
+
+
+def sheet_layout(frame, report_date=None):
+    """Колонки дневного листа из канонических метрик"""
+    if report_date:
+        date = datetime.strptime(report_date[:10], '%Y-%m-%d').strftime('%d.%m.%Y')
+    else:
+        date = (datetime.now() - timedelta(days=1)).strftime('%d.%m.%Y')
+    net_profit = frame['net_profit']
+    if net_profit.isna().any():
+        # Без маржи прибыль не посчитать — просим её внести
+        net_profit = net_profit.astype(object).where(net_profit.notna(), "ВНЕСИТЕ")
+    result = pd.DataFrame({
+        'Дата': date,
+        'Артикул WB': frame.index,
+        'Артикул продавца': frame['vendorCode'],
+        'Количество заказов за период': frame['ordersCount'],
+        'Расходы на рекламу по артикулу': frame['costs'],
+        'Сумма заказов': frame['ordersSumRub'],
+        'ДРР': frame['drr'],
+        'Чистая прибыль за период по артикулу': net_profit,
+        ' ': ' ',
+        'Показы': frame['views'],
+        'CTR (Автоматические компании)': frame['auto_ctr'],
+        'CTR (Аукционы)': frame['auction_ctr'],
+        'Конверсия в корзину': frame['addToCartConversion'],
+        'Конверсия в заказ': frame['cartToOrderConversion'],
+    }, index=frame.index, columns=SHEET_COLUMNS)
+    return result.reset_index(drop=True)
+
+
+def bot_layout(frame):
+    """Короткий отчёт бота из канонических метрик"""
+    return pd.DataFrame({
+        'Артикул WB': frame.index,
+        'Артикул продавца': frame['vendorCode'],
+        'Кол-во заказов': frame['ordersCount'],
+        'Расходы РК': frame['costs'],
+        'Прибыль': frame['net_profit'],
+    }, index=frame.index).reset_index(drop=True)
+
+
+async def calculate_metrics(orders, ad_stats_df, client_sheet_id, cabinet_name, report_date=None, client_data=None):
+    """Метрики дневного листа по артикулам с заказами"""
+    try:
+        frame = await cabinet_metrics(orders, ad_stats_df, client_sheet_id, cabinet_name, client_data)
+        return sheet_layout(frame, report_date)
     except Exception as e:
         logging.error(f"Ошибка при расчете метрик: {str(e)}")
         import traceback
@@ -149,10 +224,11 @@ async def calculate_metrics(orders, ad_stats_df, client_sheet_id, cabinet_name):
 
 async def read_config(config_sheet_url: str) -> dict:
     """Чтение конфигурации: {user: [(sheet_id, wb_api_key, sheet_name)]}"""
-    client = gspread.authorize(CREDS)
-    sheet = client.open_by_url(config_sheet_url).sheet1
-    records = sheet.get_all_records(
-        expected_headers=["Клиент", "WB ключ", "Личный кабинет", "Ссылка на таблицу"])
+    with span('sheets.read_config'), sheets_operation('read_config'):
+        client = gspread.authorize(CREDS)
+        sheet = client.open_by_url(config_sheet_url).sheet1
+        records = sheet.get_all_records(
+            expected_headers=["Клиент", "WB ключ", "Личный кабинет", "Ссылка на таблицу"])
     result = {}
     for row in records:
         link = row.get("Ссылка на таблицу")
@@ -200,119 +276,131 @@ async def get_user_cabinets(config_url: str, username: str) -> list:
         logging.error(f"Ошибка при получении кабинетов пользователя: {e}")
         return []
 
-def update_google_sheet_multi(sheet_id, sheet_name, data_df, spreadsheet):
-    if data_df.empty:
-        logging.info(f"[{sheet_name}] Нет данных для записи")
-        return
-
+def open_daily_worksheet(spreadsheet, sheet_name, columns):
+    """Возвращает (лист, создан_ли_он); новый лист получает шапку и заголовки"""
+    num_columns = len(columns)
     try:
-        num_columns = len(data_df.columns)
+        worksheet = spreadsheet.worksheet(sheet_name)
+        is_new_sheet = False
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(
+            title=sheet_name, rows="100", cols=15)
+        is_new_sheet = True
+
+    # Проверка и расширение столбцов при необходимости
+    current_col_count = worksheet.col_count
+    if num_columns > current_col_count:
+        cols_to_add = num_columns - current_col_count
+        worksheet.add_cols(cols_to_add)
+    
+    last_col_letter = gspread.utils.rowcol_to_a1(1, num_columns)[0]
+
+    if is_new_sheet:
+        # Шапка для нового листа
+        worksheet.append_row(["Ежедневная статистика"])
+        worksheet.append_row(["Таблица обновляется ежедневно с 00:00 до 01:00"])
         
-        try:
-            worksheet = spreadsheet.worksheet(sheet_name)
-            is_new_sheet = False
-        except gspread.exceptions.WorksheetNotFound:
-            worksheet = spreadsheet.add_worksheet(
-                title=sheet_name, rows="100", cols=15)
-            is_new_sheet = True
-
-        # Проверка и расширение столбцов при необходимости
-        current_col_count = worksheet.col_count
-        if num_columns > current_col_count:
-            cols_to_add = num_columns - current_col_count
-            worksheet.add_cols(cols_to_add)
+        # Форматирование шапки
+        worksheet.format('A1:A2', {
+            "textFormat": {"bold": True, "fontSize": 14},
+            "horizontalAlignment": "CENTER"
+        })
         
-        last_col_letter = gspread.utils.rowcol_to_a1(1, num_columns)[0]
+        # Объединение ячеек
+        worksheet.merge_cells(f'A1:{last_col_letter}1')
+        worksheet.merge_cells(f'A2:{last_col_letter}2')
+        
+        # Отступ и заголовки столбцов
+        worksheet.insert_row([""], index=3)
+        lst_headers = list(columns)
+        worksheet.insert_row(lst_headers, index=4)
+        
+        # Форматирование заголовков
+        header_format = {
+            "textFormat": {"bold": True},
+            "backgroundColor": {"red": 0.9, "green": 0.9, "blue": 0.9},
+            "borders": {"top": {"style": "SOLID"}, "bottom": {"style": "SOLID"}, 
+                        "left": {"style": "SOLID"}, "right": {"style": "SOLID"}},
+            "wrapStrategy": "WRAP"
+        }
+        worksheet.format(f'A4:{last_col_letter}4', header_format)
+        # Сброс только самых важных параметров
+        worksheet.format("I4", {
+            "backgroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0},  # белый фон
+            "textFormat": {"bold": False},  # обычный шрифт
+            "borders": {}  # без границ
+        })
+        worksheet.freeze(4)
+    return worksheet, is_new_sheet
+
+
+def build_day_rows(data_df):
+    """Строки одного дня для записи в лист и строка "Итого" к ним"""
+    num_columns = len(data_df.columns)
+
+    # Подготовка данных
+    values = []
+    for _, row in data_df.iterrows():
+        converted_row = []
+        for item in row:
+            if isinstance(item, np.integer):
+                converted_row.append(int(item))
+            elif isinstance(item, np.floating):
+                converted_row.append(float(item))
+            else:
+                converted_row.append(item)
+        values.append(converted_row)
 
-        if is_new_sheet:
-            # Шапка для нового листа
-            worksheet.append_row(["Ежедневная статистика"])
-            worksheet.append_row(["Таблица обновляется ежедневно с 00:00 до 01:00"])
-            
-            # Форматирование шапки
-            worksheet.format('A1:A2', {
-                "textFormat": {"bold": True, "fontSize": 14},
-                "horizontalAlignment": "CENTER"
-            })
-            
-            # Объединение ячеек
-            worksheet.merge_cells(f'A1:{last_col_letter}1')
-            worksheet.merge_cells(f'A2:{last_col_letter}2')
-            
-            # Отступ и заголовки столбцов
-            worksheet.insert_row([""], index=3)
-            lst_headers = list(data_df.columns)
-            # print(lst_headers)
-            # lst_headers.insert(8, ' ')
-            # print(lst_headers)
-            worksheet.insert_row(lst_headers, index=4)
-            
-            # Форматирование заголовков
-            header_format = {
-                "textFormat": {"bold": True},
-                "backgroundColor": {"red": 0.9, "green": 0.9, "blue": 0.9},
-                "borders": {"top": {"style": "SOLID"}, "bottom": {"style": "SOLID"}, 
-                            "left": {"style": "SOLID"}, "right": {"style": "SOLID"}},
-                "wrapStrategy": "WRAP"
-            }
-            worksheet.format(f'A4:{last_col_letter}4', header_format)
-            # Сброс только самых важных параметров
-            worksheet.format("I4", {
-                "backgroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0},  # белый фон
-                "textFormat": {"bold": False},  # обычный шрифт
-                "borders": {}  # без границ
-            })
-            worksheet.freeze(4)
-
-        # Подготовка данных
-        values = []
-        for _, row in data_df.iterrows():
-            converted_row = []
-            for item in row:
-                if isinstance(item, np.integer):
-                    converted_row.append(int(item))
-                elif isinstance(item, np.floating):
-                    converted_row.append(float(item))
-                else:
-                    converted_row.append(item)
-            values.append(converted_row)
-
-        # Расчет итогов - ИСПРАВЛЕННЫЙ БЛОК
-        total_orders = total_revenue = total_costs = total_net_profit = 0
-        col_index_map = {col: idx for idx, col in enumerate(data_df.columns)}
+    # Расчет итогов - ИСПРАВЛЕННЫЙ БЛОК
+    total_orders = total_revenue = total_costs = total_net_profit = 0
+    col_index_map = {col: idx for idx, col in enumerate(data_df.columns)}
+    
+    if 'Количество заказов за период' in data_df.columns:
+        # Используем sum() с skipna=True для числовых столбцов
+        total_orders = int(data_df['Количество заказов за период'].sum(skipna=True))
         
-        if 'Количество заказов за период' in data_df.columns:
-            # Используем sum() с skipna=True для числовых столбцов
-            total_orders = int(data_df['Количество заказов за период'].sum(skipna=True))
-            
-        if 'Сумма заказов' in data_df.columns:
-            total_revenue = float(data_df['Сумма заказов'].sum(skipna=True))
-            
-        if 'Расходы на рекламу по артикулу' in data_df.columns:
-            # Обрабатываем только числовые значения, игнорируем строки
-            total_costs = data_df['Расходы на рекламу по артикулу'].apply(
-                lambda x: float(str(x).replace(',', '.')) if isinstance(x, (int, float, str)) and str(x).replace(',', '').replace('.', '').isdigit() else 0
-            ).sum()
-            
-        if 'Чистая прибыль за период по артикулу' in data_df.columns:
-            # Обрабатываем только числовые значения, игнорируем строки
-            total_net_profit = data_df['Чистая прибыль за период по артикулу'].apply(
-                lambda x: x if isinstance(x, (int, float)) else 0
-            ).sum()
+    if 'Сумма заказов' in data_df.columns:
+        total_revenue = float(data_df['Сумма заказов'].sum(skipna=True))
         
-        # Формирование итоговой строки
-        total_row = [''] * num_columns
-        total_row[0] = 'Итого'
-        if 'Количество заказов за период' in col_index_map:
-            total_row[col_index_map['Количество заказов за период']] = int(total_orders)
-        if 'Сумма заказов' in col_index_map:
-            total_row[col_index_map['Сумма заказов']] = float(total_revenue)
-        if 'Расходы на рекламу по артикулу' in col_index_map:
-            total_row[col_index_map['Расходы на рекламу по артикулу']] = float(total_costs)
-        if 'Чистая прибыль за период по артикулу' in col_index_map:
-            total_row[col_index_map['Чистая прибыль за период по артикулу']] = float(total_net_profit)
+    if 'Расходы на рекламу по артикулу' in data_df.columns:
+        # Обрабатываем только числовые значения, игнорируем строки
+        total_costs = data_df['Расходы на рекламу по артикулу'].apply(
+            lambda x: float(str(x).replace(',', '.')) if isinstance(x, (int, float, str)) and str(x).replace(',', '').replace('.', '').isdigit() else 0
+        ).sum()
         
-        all_values = values + [total_row]
+    if 'Чистая прибыль за период по артикулу' in data_df.columns:
+        # Обрабатываем только числовые значения, игнорируем строки
+        total_net_profit = data_df['Чистая прибыль за период по артикулу'].apply(
+            lambda x: x if isinstance(x, (int, float)) else 0
+        ).sum()
+    
+    # Формирование итоговой строки
+    total_row = [''] * num_columns
+    total_row[0] = 'Итого'
+    if 'Количество заказов за период' in col_index_map:
+        total_row[col_index_map['Количество заказов за период']] = int(total_orders)
+    if 'Сумма заказов' in col_index_map:
+        total_row[col_index_map['Сумма заказов']] = float(total_revenue)
+    if 'Расходы на рекламу по артикулу' in col_index_map:
+        total_row[col_index_map['Расходы на рекламу по артикулу']] = float(total_costs)
+    if 'Чистая прибыль за период по артикулу' in col_index_map:
+        total_row[col_index_map['Чистая прибыль за период по артикулу']] = float(total_net_profit)
+    return values, total_row
+
+
+def update_google_sheet_days(sheet_name, data_dfs, spreadsheet):
+    """Дописывает в лист кабинета блоки дней (каждый со своей строкой "Итого") одной записью"""
+    data_dfs = [data_df for data_df in data_dfs if not data_df.empty]
+    if not data_dfs:
+        logging.info(f"[{sheet_name}] Нет данных для записи")
+        return False
+
+    started = time.monotonic()
+    try:
+        columns = data_dfs[0].columns
+        num_columns = len(columns)
+        worksheet, is_new_sheet = open_daily_worksheet(spreadsheet, sheet_name, columns)
+        last_col_letter = gspread.utils.rowcol_to_a1(1, num_columns)[0]
 
         # Определение стартовой строки
         if is_new_sheet:
@@ -320,6 +408,16 @@ def update_google_sheet_multi(sheet_id, sheet_name, data_df, spreadsheet):
         else:
             all_values_in_sheet = worksheet.get_all_values()
             start_row = len(all_values_in_sheet) + 1
+
+        all_values = []
+        total_rows = []
+        rows_count = 0
+        for data_df in data_dfs:
+            values, total_row = build_day_rows(data_df)
+            rows_count += len(values)
+            all_values.extend(values)
+            total_rows.append(start_row + len(all_values))
+            all_values.append(total_row)
         
         # Проверка и расширение строк
         current_row_count = worksheet.row_count
@@ -331,86 +429,220 @@ def update_google_sheet_multi(sheet_id, sheet_name, data_df, spreadsheet):
         update_range = f"A{start_row}:{last_col_letter}{start_row + len(all_values) - 1}"
         worksheet.update(range_name=update_range, values=all_values)
 
-        # Форматирование строки "Итого"
-        total_row_position = start_row + len(values)
-        total_row_range = f"A{total_row_position}:{last_col_letter}{total_row_position}"
-        
-        worksheet.format(total_row_range, {
-            "textFormat": {"bold": True},
-            "backgroundColor": {"red": 0.95, "green": 0.95, "blue": 0.95}
-        })
+        # Форматирование строк "Итого"
+        worksheet.batch_format([{
+            "range": f"A{position}:{last_col_letter}{position}",
+            "format": {
+                "textFormat": {"bold": True},
+                "backgroundColor": {"red": 0.95, "green": 0.95, "blue": 0.95}
+            }
+        } for position in total_rows])
 
-        logging.info(f"[{sheet_name}] Добавлено строк: {len(values)}")
+        logging.info(f"[{sheet_name}] Добавлено строк: {rows_count}")
+        observe_sheets('write_day', time.monotonic() - started)
+        return True
     except Exception as e:
         logging.error(f"[{sheet_name}] Ошибка при обновлении Google Таблицы: {e}")
+        observe_sheets('write_day', time.monotonic() - started, failed=True)
         import traceback
         traceback.print_exc()
+        return False
 
 
-async def generate_dayli_report(user_configs, spreadsheet, date_from):
-    
-    for sheet_id, wb_key, sheet_name in user_configs:
-        logging.info(f"\n--- Обработка ЛК: {sheet_name} ---")
-        HEADERS = {'Authorization': wb_key}
-        # Получение данных с возобновляемой обработкой
-        orders = None
-        orders_state = None
-        max_retries = 10
-        try:
-            cards = await get_wb_product_cards(HEADERS)
-            for attempt in range(max_retries):
-                orders = await get_dict_orders(HEADERS, date_from[:10], state=orders_state, cards=cards)
-                
-                # Если получили состояние для повтора
-                if isinstance(orders, dict) and orders.get('error') == 429:
-                    wait_time = 30
-                    logging.info(f"Waiting {wait_time}s for orders API (attempt {attempt+1}/{max_retries})")
-                    await asyncio.sleep(wait_time)
-                    orders_state = orders.get('state')
-                    continue
-                    
-                # Успешное завершение
-                break
-            
+def update_google_sheet_multi(sheet_id, sheet_name, data_df, spreadsheet):
+    return update_google_sheet_days(sheet_name, [data_df], spreadsheet)
+
+
+def get_sheet_dates(spreadsheet, sheet_name):
+    """Даты (дд.мм.гггг), уже записанные в лист кабинета"""
+    try:
+        worksheet = spreadsheet.worksheet(sheet_name)
+    except gspread.exceptions.WorksheetNotFound:
+        return set()
+    return {value.strip() for value in worksheet.col_values(1)[4:] if value.strip()}
+
+
+async def generate_cabinet_report(sheet_id, wb_key, sheet_name, spreadsheet, date_from, user=''):
+    """
+    Ночной отчёт одного кабинета
+
+    Этапы и частичное состояние загрузки сохраняются в журнале (WB_jobs):
+    после перезапуска бота отчёт продолжается с сохранённого места.
+
+    :return: 'ok', 'no_data', 'wb_unavailable', '429_error' или 'error'
+    """
+    HEADERS = {'Authorization': wb_key}
+    date = date_from[:10]
+    job_stage, checkpoint = get_job(user, sheet_name, date)
+    if job_stage == WRITING:
+        # Процесс прервался во время записи: проверяем, дошла ли она до листа
+        if datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y') in get_sheet_dates(spreadsheet, sheet_name):
+            save_job(user, sheet_name, date, DONE)
+            logging.info(f"[{sheet_name}] Отчёт за {date} уже записан")
+            return 'ok'
+    if wb_unavailable():
+        logging.error(f"[{sheet_name}] WB API недоступен, ЛК пропущен")
+        return 'wb_unavailable'
+    # Получение данных с возобновляемой обработкой
+    orders = load_stats(checkpoint.get('orders'), ORDER_FIELDS)
+    orders_state = load_orders_state(checkpoint.get('orders_state'))
+    max_retries = 10
+    try:
+        if orders is None:
+            with span('cards'):
+                cards = await get_catalog_cards(HEADERS)
+            with span('orders', resumed=orders_state is not None) as stage:
+                for attempt in range(max_retries):
+                    # Одновременные отчёты по тому же ключу и дню ждут одну загрузку
+                    orders = await single_flight(
+                        (wb_key, date, 'orders'),
+                        lambda notify: get_dict_orders(HEADERS, date, state=orders_state,
+                                                       cards=cards, on_progress=notify))
+
+                    # Если получили состояние для повтора
+                    if isinstance(orders, dict) and orders.get('error') == 429:
+                        # Паузу по заголовкам WB выдерживает лимитер ключа перед следующим запросом
+                        wait_time = orders.get('retry_after', 30)
+                        logging.info(f"Waiting {wait_time}s for orders API (attempt {attempt+1}/{max_retries})")
+                        orders_state = orders.get('state')
+                        save_job(user, sheet_name, date, ORDERS,
+                                 {'orders_state': dump_orders_state(orders_state)})
+                        continue
+
+                    # Успешное завершение
+                    break
+                stage.set(attempts=attempt + 1)
+
             # Если после всех попыток всё равно ошибка
             if isinstance(orders, dict) and orders.get('error') == 429:
-                return pd.DataFrame(), "429_error"
-            
-            # Получение расходов на рекламу
-            ad_stats = None
-            # ad_state = None
+                return '429_error'
+            if isinstance(orders, dict) and orders.get('error') == 'transport':
+                # Незагруженные nmID остаются в очереди до следующего запуска
+                save_job(user, sheet_name, date, ORDERS,
+                         {'orders_state': dump_orders_state(orders['state'])})
+                logging.error(f"[{sheet_name}] Заказы не получены: WB API недоступен")
+                return 'wb_unavailable'
+            # Заказы, собранные во время сбоя WB, могут быть неполными — в журнал
+            # как готовые попадают только полученные при доступном WB
+            if wb_unavailable():
+                logging.error(f"[{sheet_name}] WB API недоступен, ЛК пропущен")
+                return 'wb_unavailable'
+            checkpoint = {'orders': dump_stats(orders)}
+            save_job(user, sheet_name, date, ADS, checkpoint)
+
+        # Получение расходов на рекламу
+        ad_stats = load_stats(checkpoint.get('ad_stats'), EXPENSE_FIELDS)
+        if ad_stats is None:
+            ad_state = load_expenses_state(checkpoint.get('ad_state'))
+            ad_error = None
             max_retries = 3
-            for attempt in range(max_retries):
-                ad_stats = await get_expenses_per_nm(HEADERS, date_from)
-                
-                if isinstance(ad_stats, dict) and ad_stats.get('error') == 429:
-                    wait_time = 30
-                    logging.info(f"Waiting {wait_time}s for ads API (attempt {attempt+1}/{max_retries})")
-                    await asyncio.sleep(wait_time)
-                    continue
-                    
-                break
-            
-            if isinstance(ad_stats, dict) and ad_stats.get('error') == 429:
-                return pd.DataFrame(), "429_error"
-            metrics_df = await calculate_metrics(
-                orders, ad_stats, sheet_id, sheet_name)
-
-            if not metrics_df.empty:
-                update_google_sheet_multi(
+            with span('ads', resumed=ad_state is not None) as stage:
+                for attempt in range(max_retries):
+                    try:
+                        ad_stats = await single_flight(
+                            (wb_key, date, 'fullstats'),
+                            lambda notify: get_expenses_per_nm(HEADERS, date_from, state=ad_state))
+                        ad_error = None
+                        break
+                    except WBError as e:
+                        # Повтор продолжает загрузку с точки остановки
+                        logging.info(f"{e} (attempt {attempt+1}/{max_retries})")
+                        ad_error = e
+                        ad_state = e.state
+                        save_job(user, sheet_name, date, ADS,
+                                 {**checkpoint, 'ad_state': dump_expenses_state(ad_state)})
+                stage.set(attempts=attempt + 1)
+
+            if isinstance(ad_error, WBRateLimitError):
+                return '429_error'
+            if ad_error is not None:
+                logging.error(f"[{sheet_name}] Реклама не получена: {ad_error}")
+                return 'wb_unavailable'
+            # Данные, собранные во время сбоя WB, неполные — не записываем их
+            if wb_unavailable():
+                logging.error(f"[{sheet_name}] WB API недоступен, ЛК пропущен")
+                return 'wb_unavailable'
+            checkpoint = {'orders': checkpoint['orders'], 'ad_stats': dump_stats(ad_stats)}
+            save_job(user, sheet_name, date, METRICS, checkpoint)
+
+        with span('metrics'):
+            frame = await cabinet_metrics(orders, ad_stats, sheet_id, sheet_name)
+            metrics_df = sheet_layout(frame, date)
+
+        if not metrics_df.empty:
+            save_job(user, sheet_name, date, WRITING, checkpoint)
+            with span('sheets.write', rows=len(metrics_df)):
+                written = update_google_sheet_multi(
                     sheet_id, sheet_name, metrics_df, spreadsheet)
-            else:
-                logging.info(f"[{sheet_name}] Нет данных для записи")
-        except Exception as e:
-            logging.error(f'Ошибка генерации отчёта - {e}')
+            if not written:
+                save_job(user, sheet_name, date, METRICS, checkpoint)
+                return 'error'
+            save_job(user, sheet_name, date, DONE)
+            return 'ok'
+        logging.info(f"[{sheet_name}] Нет данных для записи")
+        save_job(user, sheet_name, date, DONE)
+        return 'no_data'
+    except Exception as e:
+        logging.error(f'Ошибка генерации отчёта - {e}')
+        return 'error'
 
 
-async def run_report(user_configs, spreadsheet, date_from):
-    async with semaphore:
-        await generate_dayli_report(user_configs, spreadsheet, date_from)
+async def generate_dayli_report(user_configs, spreadsheet, date_from, user=''):
+    """:return: {кабинет: результат generate_cabinet_report} по запрошенным кабинетам"""
+    results = {}
+    for sheet_id, wb_key, sheet_name in user_configs:
+        job = (user, sheet_name, date_from[:10])
+        # Кабинет уже записан или его отчёт идёт в другой задаче
+        if job in running_jobs or get_job(*job)[0] == DONE:
+            logging.info(f"[{sheet_name}] Отчёт за {date_from[:10]} уже записан или выполняется")
+            continue
+        logging.info(f"\n--- Обработка ЛК: {sheet_name} ---")
+        started = time.monotonic()
+        running_jobs.add(job)
+        try:
+            with trace('nightly_report', user=user, cabinet=sheet_name, date=date_from[:10]) as root:
+                result = await generate_cabinet_report(sheet_id, wb_key, sheet_name, spreadsheet, date_from, user)
+                root.set(result=result)
+        finally:
+            running_jobs.discard(job)
+        observe_report('daily', user, sheet_name, time.monotonic() - started, result)
+        results[sheet_name] = result
+        # Лимит WB исчерпан: остальные кабинеты пользователя не запрашиваем
+        if result == '429_error':
+            break
+    return results
+
+
+async def run_report(user_configs, spreadsheet, date_from, user=''):
+    global nightly_running
+    nightly_running += 1
+    nightly_idle.clear()
+    REPORT_TASKS.inc(state='waiting')
+    waiting = True
+    try:
+        async with semaphore:
+            REPORT_TASKS.dec(state='waiting')
+            waiting = False
+            REPORT_TASKS.inc(state='running')
+            try:
+                return await generate_dayli_report(user_configs, spreadsheet, date_from, user)
+            finally:
+                REPORT_TASKS.dec(state='running')
+    finally:
+        if waiting:
+            REPORT_TASKS.dec(state='waiting')
+        nightly_running -= 1
+        if nightly_running == 0:
+            nightly_idle.set()
 
 
 async def main_from_config(cache, config_url: str, date_from=None, date_to=None):
+    """
+    Ставит ночные отчёты пользователей в очередь
+
+    :return: Задачи run_report (по одной на пользователя) или None, если
+             конфигурацию не удалось прочитать
+    """
     print(1)
     if not date_from:
         date_from = datetime.now() - timedelta(days=1)  # Минус 1 день
@@ -422,7 +654,9 @@ async def main_from_config(cache, config_url: str, date_from=None, date_to=None)
 
     logging.info(f"\nОбработка данных за период: {date_from} - {date_to}")
 
+    tasks = []
     try:
+        prune_jobs()
         configs = await read_config(config_url)
         client = gspread.authorize(CREDS)
         for user, user_configs in configs.items():
@@ -432,81 +666,190 @@ async def main_from_config(cache, config_url: str, date_from=None, date_to=None)
                 logging.info(f"\n--- Не оплачена подписка:  ---")
                 continue
             spreadsheet = client.open_by_key(user_configs[0][0])
-            asyncio.create_task(run_report(user_configs, spreadsheet, date_from))
+            queue_jobs(user, [sheet_name for _, _, sheet_name in user_configs], date_from[:10])
+            tasks.append(asyncio.create_task(run_report(user_configs, spreadsheet, date_from, user)))
 
     except Exception as e:
         logging.error(f"Критическая ошибка: {e}")
-
-async def calculate_metrics_for_bot(orders, ad_stats_df, client_sheet_id, cabinet_name):
-    try:
-        # Получаем все данные из таблицы клиента одним запросом
-        client_data = {}
-        if client_sheet_id:
-            client_data = await get_client_data(client_sheet_id, cabinet_name)
-
-        for nmId in orders.keys():
-            if nmId in ad_stats_df:
-                orders[nmId]['costs'] = round(ad_stats_df[nmId]['sum'], 2)
-                # orders[nmId]['views'] = round(ad_stats_df[nmId]['views'], 2)
-                # orders[nmId]['auto_ctr'] = round(ad_stats_df[nmId]['auto_ctr'], 2)
-                # orders[nmId]['auction_ctr'] = round(ad_stats_df[nmId]['auction_ctr'], 2)
-            else:
-                orders[nmId]['costs'] = 0 
-            
-            if nmId in client_data:
-                if client_data[nmId]['profit'] != '' and client_data[nmId]['redemption'] != '':
-                    orders[nmId]['redemption_rate'] = float(client_data[nmId]['redemption']) / 100
-                    orders[nmId]['profit_per_unit'] = float(client_data[nmId]['profit'])
-
-                    # Расчёт прибыли
-                    orders[nmId]['gross_profit'] = round(orders[nmId]['profit_per_unit'] * orders[nmId]['ordersCount'] * orders[nmId]['redemption_rate'], 2)
-                else:
-                    orders[nmId]['redemption_rate'] = None
-                    orders[nmId]['profit_per_unit'] = None
-                    orders[nmId]['gross_profit']= None
-            else:
-                orders[nmId]['redemption_rate'] = None
-                orders[nmId]['profit_per_unit'] = None
-                orders[nmId]['gross_profit']= None
-        result = []
-        for nmId, values in orders.items():
-            if nmId in client_data:
-                vendorCode = client_data[nmId]['vendorCode']
-            else:
-                vendorCode = 'Нет в таблице'
-            if values['ordersCount'] != 0:
-                result.append([nmId, vendorCode, values['ordersCount'], values['costs'], values['gross_profit']])
-        result = pd.DataFrame(result, columns=['nmId', 'vendorCode', 'ordersCount', 'costs', 'gross_profit'])
+        return None
+    return tasks
+
+
+async def nightly_reports(cache, config_url):
+    """
+    Задача планировщика: запускает ночные отчёты и ждёт все кабинеты, чтобы
+    длительность и ошибки задачи относились ко всему прогону. Кабинеты,
+    не записанные из-за ошибок, недоступности WB или 429, поднимают исключение.
+    """
+    tasks = await main_from_config(cache, config_url)
+    if tasks is None:
+        raise RuntimeError("Ночной отчёт не запущен: ошибка чтения конфигурации")
+    failed = [f"{sheet_name}: {result}"
+              for results in await asyncio.gather(*tasks)
+              for sheet_name, result in results.items()
+              if result not in ('ok', 'no_data')]
+    if failed:
+        raise RuntimeError(f"Ночной отчёт завершён с ошибками: {', '.join(failed)}")
+
+async def resume_reports(cache, config_url):
+    """
+    Продолжает ночные отчёты, прерванные перезапуском бота
+
+    Дни с незавершёнными кабинетами берутся из журнала (WB_jobs); записанные
+    кабинеты generate_dayli_report пропускает.
+    """
+    for date in unfinished_dates():
+        logging.info(f"Продолжение ночного отчёта за {date}")
+        await main_from_config(cache, config_url, date_from=f"{date}T00:00:00")
+
+
+def load_backfill_state():
+    if os.path.exists(BACKFILL_FILE):
+        try:
+            with open(BACKFILL_FILE, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Ошибка загрузки состояния догрузки: {e}")
+    return {}
 
 
-        for index, row in result.iterrows():
-            if pd.notna(result.at[index, 'costs']) and pd.notna(result.at[index, 'gross_profit']):            
-                result.at[index, 'net_profit'] = (result.at[index, 'gross_profit'] -
-                                                  result.at[index, 'costs']).round(2)
-            else:
-                result.at[index, 'net_profit'] = None
-        try:
-            result = result.rename(columns={
-                'nmId': 'Артикул WB',
-                'vendorCode': 'Артикул продавца',
-                'ordersCount': 'Кол-во заказов',
-                'costs': 'Расходы РК',
-                'net_profit': 'Прибыль'
-            })
-            return result[[
-                'Артикул WB',
-                'Артикул продавца',
-                'Кол-во заказов',
-                'Расходы РК',
-                'Прибыль'
-            ]]
-        except:
-            return pd.DataFrame()
+def save_backfill_state(backfill_state):
+    try:
+        with open(BACKFILL_FILE, 'w') as f:
+            json.dump(backfill_state, f)
     except Exception as e:
-        logging.error(f"Ошибка при расчете метрик: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return pd.DataFrame()
+        logging.error(f"Ошибка сохранения состояния догрузки: {e}")
+
+
+async def fetch_orders_by_day(HEADERS, nm_ids, date_from, date_to):
+    """Заказы по дням за интервал: {дата: NmStats} или None, если WB их не отдал"""
+    orders = None
+    orders_state = None
+    max_retries = 10
+    for attempt in range(max_retries):
+        orders = await get_orders_statistics(HEADERS, nm_ids, date_from, date_to,
+                                             state=orders_state, per_day=True)
+        if isinstance(orders, dict) and orders.get('error') == 429:
+            logging.info(f"Waiting {orders.get('retry_after', 30)}s for orders API (attempt {attempt+1}/{max_retries})")
+            orders_state = orders.get('state')
+            continue
+        if isinstance(orders, dict) and orders.get('error') == 'transport':
+            return None
+        return orders
+    return None
+
+
+async def backfill_cabinet(sheet_user, sheet_name, config_url, date_from, date_to):
+    """
+    Догружает в дневной лист кабинета дни интервала, которых в нём ещё нет.
+
+    Заказы запрашиваются окнами по ORDERS_MAX_DAYS дней, реклама — одним
+    интервалом. Детальная история WB отдаёт заказы только с
+    orders_history_start(), более ранние дни интервала пропускаются.
+    Посчитанные дни сохраняются в BACKFILL_FILE, поэтому
+    прерванная догрузка не запрашивает их повторно. Все недостающие дни
+    записываются в лист одним обновлением.
+
+    :return: Количество записанных дней
+    """
+    configs = await read_config(config_url)
+    cabinet = next(((sheet_id, wb_key)
+                    for sheet_id, wb_key, config_sheet_name in configs.get(sheet_user, [])
+                    if config_sheet_name == sheet_name), None)
+    if not cabinet:
+        logging.error(f"Кабинет {sheet_user} [{sheet_name}] не найден")
+        return 0
+    sheet_id, wb_key = cabinet
+    HEADERS = {'Authorization': wb_key}
+
+    async with backfill_semaphore:
+        client = gspread.authorize(CREDS)
+        spreadsheet = client.open_by_key(sheet_id)
+        existing = get_sheet_dates(spreadsheet, sheet_name)
+        days = [day for window in date_windows(date_from, date_to) for day in window]
+        # Заказов за более ранние дни WB не отдаёт: без них дни получились бы пустыми
+        earliest = orders_history_start()
+        if days and days[0] < earliest:
+            logging.warning(f"[{sheet_name}] Дни до {earliest} пропущены: детальная история WB за них недоступна")
+            days = [day for day in days if day >= earliest]
+        missing = [day for day in days
+                   if datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m.%Y') not in existing]
+        if not missing:
+            logging.info(f"[{sheet_name}] Все дни интервала уже есть в листе")
+            return 0
+
+        backfill_state = load_backfill_state()
+        key = f"{sheet_user}|{sheet_name}"
+        checkpoint = backfill_state.setdefault(key, {})
+        to_fetch = [day for day in missing if day not in checkpoint]
+
+        if to_fetch:
+            # Ночной отчёт в приоритете: ждём, пока он закончит
+            await nightly_idle.wait()
+            cards = await get_catalog_cards(HEADERS)
+            if not cards:
+                return 0
+            nm_ids = [product['nmID'] for product in cards]
+            client_data = await get_client_data(sheet_id, sheet_name)
+            ads_by_day = None
+            ads_state = None
+            for attempt in range(BACKFILL_ADS_RETRIES):
+                try:
+                    ads_by_day = await get_expenses_per_day(HEADERS, to_fetch[0], to_fetch[-1], state=ads_state)
+                    break
+                except WBError as e:
+                    logging.warning(f"[{sheet_name}] {e} (attempt {attempt+1}/{BACKFILL_ADS_RETRIES})")
+                    ads_state = e.state
+            if ads_by_day is None:
+                logging.error(f"[{sheet_name}] Не удалось получить рекламу за {to_fetch[0]} - {to_fetch[-1]}")
+                return 0
+
+            for window in date_windows(to_fetch[0], to_fetch[-1], ORDERS_MAX_DAYS):
+                window = [day for day in window if day in to_fetch]
+                if not window:
+                    continue
+                await nightly_idle.wait()
+                orders_by_day = await fetch_orders_by_day(HEADERS, nm_ids, window[0], window[-1])
+                if orders_by_day is None:
+                    logging.error(f"[{sheet_name}] Не удалось получить заказы за {window[0]} - {window[-1]}")
+                    continue
+                for day in window:
+                    metrics_df = await calculate_metrics(
+                        orders_by_day.get(day) or NmStats(ORDER_FIELDS), ads_by_day.get(day) or NmStats(EXPENSE_FIELDS),
+                        sheet_id, sheet_name, report_date=day, client_data=client_data)
+                    # Сохраняем посчитанный день, чтобы не запрашивать его повторно
+                    checkpoint[day] = {
+                        'columns': list(metrics_df.columns),
+                        'rows': metrics_df.astype(object).where(metrics_df.notna(), None).values.tolist()
+                    }
+                save_backfill_state(backfill_state)
+
+        day_dfs = [pd.DataFrame(checkpoint[day]['rows'], columns=checkpoint[day]['columns'])
+                   for day in missing if day in checkpoint]
+        written = sum(1 for day_df in day_dfs if not day_df.empty)
+        if written and not update_google_sheet_days(sheet_name, day_dfs, spreadsheet):
+            return 0
+
+        for day in missing:
+            checkpoint.pop(day, None)
+        if not checkpoint:
+            backfill_state.pop(key, None)
+        save_backfill_state(backfill_state)
+        logging.info(f"[{sheet_name}] Догружено дней: {written}")
+        return written
+
+
+async def bot_report(frame):
+    """Таблица и сводка отчёта бота из канонических метрик"""
+    metrics_df = bot_layout(frame)
+    summary = await generate_summary(metrics_df)
+    result = metrics_df[[
+        'Артикул продавца',
+        'Кол-во заказов',
+        'Расходы РК',
+        'Прибыль'
+    ]]
+    return result, summary
 
 async def generate_summary(df):
     """Генерирует краткую сводку по отчету"""
@@ -530,7 +873,7 @@ async def generate_summary(df):
         logging.error(f"Ошибка при формировании сводки: {e}")
         return "Не удалось сформировать сводку"
 
-async def generate_report(sheet_user: str, sheet_name: str, config_url: str, date_from=None, date_to=None) -> tuple:
+async def generate_report(sheet_user: str, sheet_name: str, config_url: str, date_from=None, date_to=None, progress=None) -> tuple:
     if not date_from:
         date_from = datetime.now().replace(hour=0, minute=0, second=0,
                                            microsecond=0).strftime('%Y-%m-%dT%H:%M:%S')
@@ -544,67 +887,91 @@ async def generate_report(sheet_user: str, sheet_name: str, config_url: str, dat
                 if config_sheet_name == sheet_name and user == sheet_user:
                     WB_API_KEY = wb_key
                     HEADERS = {'Authorization': WB_API_KEY}
+                    started = time.monotonic()
+
+                    def finish(df, summary, result):
+                        observe_report('bot', user, sheet_name, time.monotonic() - started, result)
+                        return df, summary
+
+                    if wb_unavailable():
+                        return finish(pd.DataFrame(), "wb_unavailable", 'wb_unavailable')
                     
                     # Получение данных с возобновляемой обработкой
                     orders = None
                     orders_state = None
                     max_retries = 10
-                    cards = await get_wb_product_cards(HEADERS)
-                    for attempt in range(max_retries):
-                        orders = await get_dict_orders(HEADERS, date_from[:10], state=orders_state, cards=cards)
+                    with span('cards'):
+                        cards = await get_catalog_cards(HEADERS)
+                    with span('orders') as stage:
+                        for attempt in range(max_retries):
+                            orders = await single_flight(
+                                (WB_API_KEY, date_from[:10], 'orders'),
+                                lambda notify: get_dict_orders(HEADERS, date_from[:10], state=orders_state,
+                                                               cards=cards, on_progress=notify),
+                                on_progress=progress)
                         
-                        # Если получили состояние для повтора
-                        if isinstance(orders, dict) and orders.get('error') == 429:
-                            wait_time = 30
-                            logging.info(f"[{sheet_name}] Waiting {wait_time}s for orders API (attempt {attempt+1}/{max_retries})")
-                            await asyncio.sleep(wait_time)
-                            orders_state = orders.get('state')
-                            continue
+                            # Если получили состояние для повтора
+                            if isinstance(orders, dict) and orders.get('error') == 429:
+                                # Паузу по заголовкам WB выдерживает лимитер ключа перед следующим запросом
+                                wait_time = orders.get('retry_after', 30)
+                                logging.info(f"[{sheet_name}] Waiting {wait_time}s for orders API (attempt {attempt+1}/{max_retries})")
+                                orders_state = orders.get('state')
+                                continue
                             
-                        # Успешное завершение
-                        break
+                            # Успешное завершение
+                            break
+                        stage.set(attempts=attempt + 1)
                     
                     # Если после всех попыток всё равно ошибка
                     if isinstance(orders, dict) and orders.get('error') == 429:
-                        return pd.DataFrame(), "429_error"
+                        return finish(pd.DataFrame(), "429_error", '429_error')
+                    if isinstance(orders, dict) and orders.get('error') == 'transport':
+                        return finish(pd.DataFrame(), "wb_unavailable", 'wb_unavailable')
                     
                     max_retries = 3
                     # Получение расходов на рекламу
                     ad_stats = None
                     ad_state = None
-                    for attempt in range(max_retries):
-                        ad_stats = await get_expenses_per_nm(HEADERS, date_from)
-                        
-                        if isinstance(ad_stats, dict) and ad_stats.get('error') == 429:
-                            wait_time = 30
-                            logging.info(f"[{sheet_name}] Waiting {wait_time}s for ads API (attempt {attempt+1}/{max_retries})")
-                            await asyncio.sleep(wait_time)
-                            continue
-                            
-                        break
+                    ad_error = None
+                    with span('ads') as stage:
+                        for attempt in range(max_retries):
+                            try:
+                                ad_stats = await single_flight(
+                                    (WB_API_KEY, date_from[:10], 'fullstats'),
+                                    lambda notify: get_expenses_per_nm(HEADERS, date_from, state=ad_state))
+                                ad_error = None
+                                break
+                            except WBError as e:
+                                # Повтор продолжает загрузку с точки остановки
+                                logging.info(f"[{sheet_name}] {e} (attempt {attempt+1}/{max_retries})")
+                                ad_error = e
+                                ad_state = e.state
+                        stage.set(attempts=attempt + 1)
                     
-                    if isinstance(ad_stats, dict) and ad_stats.get('error') == 429:
-                        return pd.DataFrame(), "429_error"
+                    if isinstance(ad_error, WBRateLimitError):
+                        return finish(pd.DataFrame(), "429_error", '429_error')
+                    if ad_error is not None:
+                        return finish(pd.DataFrame(), "wb_unavailable", 'wb_unavailable')
+                    if wb_unavailable():
+                        return finish(pd.DataFrame(), "wb_unavailable", 'wb_unavailable')
                     
                     # Формирование отчета
-                    metrics_df = await calculate_metrics_for_bot(orders, ad_stats, sheet_id, sheet_name)
-                    summary = await generate_summary(metrics_df)
+                    with span('metrics'):
+                        frame = await cabinet_metrics(orders, ad_stats, sheet_id, sheet_name)
+                        result, summary = await bot_report(frame)
                     logging.info(f'{user} [{sheet_name}] Метрики посчитаны')
-                    try:
-                        result = metrics_df[[
-                            'Артикул продавца',
-                            'Кол-во заказов',
-                            'Расходы РК',
-                            'Прибыль'
-                        ]]
-                    except:
-                        result = pd.DataFrame()
-                    return result, summary
+                    return finish(result, summary, 'ok' if not result.empty else 'no_data')
 
         return pd.DataFrame(), ""
     except Exception as e:
         logging.error(f"Report generation error: {e}")
         return pd.DataFrame(), ""
 
+async def main():
+    try:
+        await main_from_config({}, CONFIG_URL)
+    finally:
+        await close_sessions()
+
 if __name__ == "__main__":
-    asyncio.run(main_from_config({}, CONFIG_URL))
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
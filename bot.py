@@ -3,9 +3,9 @@ from datetime import datetime, date, timedelta
 import asyncio
 import logging
 import json
+import time
 import os
 import gspread
-import aiohttp
 import pandas as pd
 import tempfile
 from aiogram import Bot, Dispatcher, types
@@ -18,14 +18,35 @@ from aiogram.utils.exceptions import MessageNotModified
 from aiogram.types import LabeledPrice
 
 from config import API_TOKEN, CONFIG_URL, ADMIN_IDS, CREDS, CONFIG_SHEET_ID, MOSCOW_TZ, DEFAULT_TIME, DATA_FILE, SUBSCRIPTION_PRICE, PAYMENT_PROVIDER_TOKEN, PAYMENT_TITLE, PAYMENT_DESCRIPTION
-from Wb_bot import get_available_users_from_config, get_user_cabinets, generate_report, main_from_config
-from WB_orders import get_wb_product_cards
+from Wb_bot import get_available_users_from_config, get_user_cabinets, generate_report, nightly_reports, backfill_cabinet, resume_reports
+from WB_catalog import get_catalog_cards
+from WB_ads import invalidate_campaigns
+from WB_orders import orders_history_start
+from WB_http import get_session, close_sessions, ANALYTICS_API, ADVERT_API
+from WB_metrics import start_metrics_server, stop_metrics_server, timed_job, TELEGRAM_LATENCY, TELEGRAM_FAILURES
+from WB_tracing import trace, span
 
 # Добавляем клавиатуру с кнопкой "Главное меню"
 main_menu_keyboard = ReplyKeyboardMarkup(resize_keyboard=True).add(KeyboardButton("Главное меню"))
 
+class InstrumentedBot(Bot):
+    """Bot, учитывающий время и ошибки вызовов Telegram Bot API в метриках"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.monotonic()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            TELEGRAM_FAILURES.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            # getUpdates — долгий опрос, его время не показательно
+            if method != 'getUpdates':
+                TELEGRAM_LATENCY.observe(time.monotonic() - started, method=method)
+
+
 # Инициализация бота и планировщика
-bot = Bot(token=API_TOKEN)
+bot = InstrumentedBot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 scheduler = AsyncIOScheduler()
@@ -87,26 +108,25 @@ def validate_cabinet_name(name: str) -> bool:
     return name.isidentifier() and (1 <= len(name.strip()) <= 50)
 
 async def validate_wb_api_key(api_key: str) -> bool:
-    url_stat = "https://seller-analytics-api.wildberries.ru/ping"
-    url_ads = "https://advert-api.wildberries.ru/ping"
+    url_stat = f"{ANALYTICS_API}/ping"
+    url_ads = f"{ADVERT_API}/ping"
     headers = {"Authorization": api_key}
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url_stat, headers=headers) as response_stat:
-                if response_stat.status != 200:
-                    return False
-        except Exception as e:
-            logging.error(f"Ошибка проверки API ключа (stat): {e}")
-            return False
+    try:
+        async with get_session(url_stat).get(url_stat, headers=headers) as response_stat:
+            if response_stat.status != 200:
+                return False
+    except Exception as e:
+        logging.error(f"Ошибка проверки API ключа (stat): {e}")
+        return False
 
-        try:
-            async with session.get(url_ads, headers=headers) as response_ads:
-                if response_ads.status != 200:
-                    return False
-        except Exception as e:
-            logging.error(f"Ошибка проверки API ключа (ads): {e}")
-            return False
+    try:
+        async with get_session(url_ads).get(url_ads, headers=headers) as response_ads:
+            if response_ads.status != 200:
+                return False
+    except Exception as e:
+        logging.error(f"Ошибка проверки API ключа (ads): {e}")
+        return False
 
     return True
 
@@ -286,6 +306,40 @@ async def check_sub(message: types.Message):
     await bot.send_message(message.chat.id, str(res))
     return
 
+@dp.message_handler(commands=["backfill"])
+async def backfill_handler(message: types.Message):
+    """/backfill <клиент> <кабинет> <YYYY-MM-DD> <YYYY-MM-DD> — догрузка пропущенных дней"""
+    if not is_admin(message.from_user.id):
+        return
+    args = message.get_args().split()
+    try:
+        username, cabinet, date_from, date_to = args
+        if datetime.strptime(date_from, '%Y-%m-%d') > datetime.strptime(date_to, '%Y-%m-%d'):
+            raise ValueError
+    except ValueError:
+        await message.answer("Использование: /backfill <клиент> <кабинет> <YYYY-MM-DD> <YYYY-MM-DD>")
+        return
+
+    earliest = orders_history_start()
+    if date_to < earliest:
+        await message.answer(f"❌ WB отдаёт детальную историю заказов только с {earliest}")
+        return
+    if date_from < earliest:
+        await message.answer(f"⚠️ WB отдаёт детальную историю заказов только с {earliest}: "
+                             f"дни с {date_from} до {earliest} пропущены")
+        date_from = earliest
+
+    await message.answer(f"⏳ Догрузка {cabinet} за {date_from} - {date_to} запущена")
+    asyncio.create_task(run_backfill(message.chat.id, username, cabinet, date_from, date_to))
+
+async def run_backfill(chat_id, username, cabinet, date_from, date_to):
+    try:
+        written = await backfill_cabinet(username, cabinet, CONFIG_URL, date_from, date_to)
+        await bot.send_message(chat_id, f"✅ {cabinet}: догружено дней — {written}")
+    except Exception as e:
+        logging.error(f"Ошибка догрузки {username} [{cabinet}]: {e}")
+        await bot.send_message(chat_id, f"❌ Ошибка догрузки {cabinet}")
+
 @dp.callback_query_handler(lambda c: c.data == "subscribe")
 async def buy_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
@@ -757,7 +811,7 @@ async def send_report_as_file(chat_id: int, username: str, cabinet_name: str, df
         with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as temp_file:
             file_path = temp_file.name
 
-        with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
+        with span('xlsx', rows=len(df)), pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
             df = df.fillna(value=" ВНЕСИТЕ")
             df.to_excel(writer, sheet_name='Отчет', index=False)
             workbook = writer.book
@@ -801,17 +855,23 @@ async def send_report_as_file(chat_id: int, username: str, cabinet_name: str, df
         excel_file = InputFile(file_path, filename=file_name)
 
         logging.info('Отправляю файл')
-        await bot.send_document(
-            chat_id=chat_id,
-            document=excel_file,
-            caption=f"📊 Отчет по ЛК: {cabinet_name}"
-        )
+        with span('telegram.send_document'):
+            await bot.send_document(
+                chat_id=chat_id,
+                document=excel_file,
+                caption=f"📊 Отчет по ЛК: {cabinet_name}"
+            )
         logging.info('Файл отправлен')
         os.unlink(file_path)
     except Exception as e:
         logging.error(f"Ошибка создания Excel-отчета: {e}")
         await bot.send_message(chat_id, "❌ Ошибка формирования отчета в формате Excel")
 
+async def traced_report(username, cabinet_name):
+    """Отчёт по одному кабинету отдельным интервалом в трассе кнопки «Все»"""
+    with span('cabinet_report', cabinet=cabinet_name):
+        return await generate_report(username, cabinet_name, CONFIG_URL)
+
 @dp.callback_query_handler(lambda c: c.data.startswith("get_report:"))
 async def process_report_callback(callback: types.CallbackQuery):
     try:
@@ -844,67 +904,89 @@ async def process_report_callback(callback: types.CallbackQuery):
         # Если не удалось отредактировать, отправляем новое сообщение
         wait_message = await bot.send_message(user_id, "🔄 Формирую отчёт, это займёт некоторое время...")
 
-    try:
-        if cabinet == "all":
-            cabinets = await cache.get_user_cabinets(username)
-            if not cabinets:
-                await bot.send_message(user_id, f"⚠️ У пользователя {username} нет доступных личных кабинетов.")
-                return
+    with trace('telegram_report', user_id=user_id, user=username, cabinet=cabinet):
+        try:
+            if cabinet == "all":
+                cabinets = await cache.get_user_cabinets(username)
+                if not cabinets:
+                    await bot.send_message(user_id, f"⚠️ У пользователя {username} нет доступных личных кабинетов.")
+                    return
 
-            summ = {'costs': 0.0, 'profit': 0.0}
-            tasks = []
-            results = []
+                summ = {'costs': 0.0, 'profit': 0.0}
+                tasks = []
+                results = []
 
-            for cabinet_name in cabinets:
-                task = asyncio.create_task(
-                    generate_report(username, cabinet_name, CONFIG_URL)
-                )
-                tasks.append(task)
+                for cabinet_name in cabinets:
+                    task = asyncio.create_task(
+                        traced_report(username, cabinet_name)
+                    )
+                    tasks.append(task)
+            
+                done, pending = await asyncio.wait(tasks, timeout=60.0)
             
-            done, pending = await asyncio.wait(tasks, timeout=60.0)
+                for task in done:
+                    try:
+                        df, summary = task.result()
+                        results.append((df, summary))
+                    except Exception as e:
+                        logging.error(f"Ошибка генерации отчета: {e}")
+                        await bot.send_message(user_id, f"⚠️ Ошибка при генерации отчета для одного из кабинетов")
+                        continue
+
+                for df, summary in results:    
+                    if summary == "429_error":
+                        await bot.send_message(user_id, "⚠️ Превышен лимит запросов. Попробуйте позже")
+                        return
+                    if summary == "wb_unavailable":
+                        await bot.send_message(user_id, "⚠️ WB API недоступен. Попробуйте позже")
+                        return
+                    if df is not None and not df.empty:
+                        logging.info(f"Метрики: {summary}")
+                        summ_parts = summary.split(':')
+                        summ["costs"] += float(summ_parts[1])
+                        if pd.notna(summ_parts[2]):
+                            summ["profit"] += float(summ_parts[2])
+
+                await bot.send_message(user_id, 
+                    f"<b>Суммарный отчёт по всем кабинетам:</b>\n"
+                    f"• Сумма затрат: {round(summ['costs'], 2)} руб\n"
+                    f"• Сумма прибыли: {round(summ['profit'], 2)} руб",
+                    parse_mode="HTML"
+                )
+            else:
+                last_progress = {'time': datetime.min}
+
+                async def report_progress(done, total):
+                    # Обновляем сообщение не чаще раза в 5 секунд
+                    now = datetime.now()
+                    if done < total and (now - last_progress['time']).total_seconds() < 5:
+                        return
+                    last_progress['time'] = now
+                    try:
+                        await wait_message.edit_text(
+                            f"🔄 Формирую отчёт, это займёт некоторое время...\n"
+                            f"Заказы: {done}/{total} артикулов")
+                    except Exception:
+                        pass
+
+                df, summary = await generate_report(username, cabinet, CONFIG_URL, progress=report_progress)
             
-            for task in done:
-                try:
-                    df, summary = task.result()
-                    results.append((df, summary))
-                except Exception as e:
-                    logging.error(f"Ошибка генерации отчета: {e}")
-                    await bot.send_message(user_id, f"⚠️ Ошибка при генерации отчета для одного из кабинетов")
-                    continue
-
-            for df, summary in results:    
                 if summary == "429_error":
                     await bot.send_message(user_id, "⚠️ Превышен лимит запросов. Попробуйте позже")
                     return
-                if df is not None and not df.empty:
-                    logging.info(f"Метрики: {summary}")
-                    summ_parts = summary.split(':')
-                    summ["costs"] += float(summ_parts[1])
-                    if pd.notna(summ_parts[2]):
-                        summ["profit"] += float(summ_parts[2])
-
-            await bot.send_message(user_id, 
-                f"<b>Суммарный отчёт по всем кабинетам:</b>\n"
-                f"• Сумма затрат: {round(summ['costs'], 2)} руб\n"
-                f"• Сумма прибыли: {round(summ['profit'], 2)} руб",
-                parse_mode="HTML"
-            )
-        else:
-            df, summary = await generate_report(username, cabinet, CONFIG_URL)
-            
-            if summary == "429_error":
-                await bot.send_message(user_id, "⚠️ Превышен лимит запросов. Попробуйте позже")
-                return
+                if summary == "wb_unavailable":
+                    await bot.send_message(user_id, "⚠️ WB API недоступен. Попробуйте позже")
+                    return
                 
-            if df is None or df.empty:
-                await bot.send_message(user_id, f"ℹ️ Нет данных по {cabinet}")
-            else:
-                await send_report_as_file(user_id, username, cabinet, df, summary)
-    finally:
-        try:
-            await bot.delete_message(user_id, wait_message.message_id)
-        except:
-            pass
+                if df is None or df.empty:
+                    await bot.send_message(user_id, f"ℹ️ Нет данных по {cabinet}")
+                else:
+                    await send_report_as_file(user_id, username, cabinet, df, summary)
+        finally:
+            try:
+                await bot.delete_message(user_id, wait_message.message_id)
+            except:
+                pass
     await show_main_menu(callback.message.chat.id)
 
 async def add_articles_to_sheet(worksheet, articles):
@@ -985,7 +1067,8 @@ async def sort_sheet(worksheet):
 async def get_wb_articles(api_key: str):
     headers = {"Authorization": api_key}
     try:
-        cards = await get_wb_product_cards(headers)
+        # Догружаем изменения в локальный каталог карточек
+        cards = await get_catalog_cards(headers, force=True) or []
         nm_ids = [(product['nmID'], product['vendorCode']) for product in cards]
         unique_pairs = set()
         for item in nm_ids:
@@ -1563,6 +1646,8 @@ async def refresh_articles_callback(callback: types.CallbackQuery, state: FSMCon
         logging.error(f"Ошибка редактирования сообщения: {e}")
         # Если не удалось отредактировать, отправляем новое сообщение    
         msg = await bot.send_message(callback.from_user.id, "⏳ Ожидайте 30 секунд, идёт обработка...", reply_markup=main_menu_keyboard)
+    # Вместе с артикулами обновляем и состав рекламных кампаний
+    invalidate_campaigns(api_key)
     try:
         spreadsheet = gc.open_by_url(spreadsheet_url)
         # worksheet = spreadsheet.get_worksheet(0)
@@ -1624,7 +1709,7 @@ async def on_startup(dp):
 
 
     scheduler.add_job(
-        main_from_config,
+        timed_job("generate_reports", nightly_reports),
         'cron',
         hour=0,
         minute=30,
@@ -1634,7 +1719,7 @@ async def on_startup(dp):
     )
 
     scheduler.add_job(
-        cache.save_data,
+        timed_job("daily_config_update", cache.save_data),
         'cron',
         hour=1,
         minute=10,
@@ -1643,7 +1728,7 @@ async def on_startup(dp):
     )
 
     scheduler.add_job(
-        check_subscriptions,
+        timed_job("dayli_subscription_check", check_subscriptions),
         'cron',
         hour=1,
         minute=10,
@@ -1652,9 +1737,14 @@ async def on_startup(dp):
     )
 
     scheduler.start()
+    await start_metrics_server()
+    # Ночные отчёты, прерванные перезапуском, продолжаются с сохранённого места
+    asyncio.create_task(resume_reports(cache, CONFIG_URL))
 
 async def on_shutdown(dp):
     scheduler.shutdown()
+    await stop_metrics_server()
+    await close_sessions()
 
 @dp.callback_query_handler(lambda c: c.data == "faq")
 async def faq_callback(callback: types.CallbackQuery):